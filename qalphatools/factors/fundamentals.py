@@ -1,116 +1,164 @@
 # Code adapted from https://github.com/pbharrin/alpha-compiler/tree/master/alphacompiler
 
-from qalphatools.utils.bundle import get_ticker_sid_dict_from_bundle
+from qalphatools.utils.store import get_cursor, get_panel, get_columns
 
 import numpy as np
+import os
 
 from zipline.pipeline.factors import CustomFactor
 from zipline.utils.paths import zipline_root
 
 
+# Sharadar SF1 dimensions: as reported (AR) or most recent (MR), and quarterly, annual or trailing twelve months
+SF1_DIMENSIONS = ['ARQ', 'ARY', 'ART', 'MRQ', 'MRY', 'MRT']
+
+
 class SparseDataFactor(CustomFactor):
     """Abstract Base Class to be used for computing sparse data.
-    The data is packed and persisted into a NumPy binary data file
-    in a previous step.
+    The data is packed and persisted into a store of plain NumPy binary
+    files in a previous step, and memory-mapped read-only here.
+
+    The data is ragged: the filings of all sids are concatenated, and the
+    filings of sid s are at offsets[s]:offsets[s + 1]. The time index into the
+    filings lives in a cursor shared by every factor reading the same store,
+    so each store is loaded once per process and its time index moves once
+    per session.
+
+    Every field is a separate column file, mapped on first use. Reading a single
+    output of the factor, e.g. Fundamentals().marketcap, gives a factor with that
+    output alone, so a pipeline only maps and copies the fields it references.
 
     This class must be subclassed with class variable 'outputs' set.  The fields
     in 'outputs' should match those persisted."""
     inputs = []
     window_length = 1
+    fill_value = np.nan  # output of assets without data on or before the session
 
     def __init__(self, *args, **kwargs):
-        self.time_index = None
-        self.curr_date = None # date for which time_index is accurate
-        self.data = None
-        self.data_path = "please_specify_.npy_file"
-
-    def bs(self, arr):
-        """Binary Search"""
-        if len(arr) == 1:
-            if self.curr_date < arr[0]:
-                return 0
-            else: return 1
-
-        mid = int(len(arr) / 2)
-        if self.curr_date < arr[mid]:
-            return self.bs(arr[:mid])
-        else:
-            return mid + self.bs(arr[mid:])
-
-    def bs_sparse_time(self, sid):
-        """For each security find the best range in the sparse data."""
-        dates_for_sid = self.data.date[sid]
-        if np.isnan(dates_for_sid[0]):
-            return 0
-
-        # do a binary search of the dates array finding the index
-        # where self.curr_date will lie.
-        non_nan_dates = dates_for_sid[~np.isnan(dates_for_sid)]
-        return self.bs(non_nan_dates) - 1
-
-    def cold_start(self, today, assets):
-        if self.data is None:
-            self.data = np.load(self.data_path, allow_pickle=True)
-
-        self.M = self.data.date.shape[1]
-
-        # for each sid, do binary search of date array to find current index
-        # the results can be shared across all factors that inherit from SparseDataFactor
-        # this sets an array of ints: time_index
-        self.time_index = np.full(self.N, -1, np.dtype('int64'))
-        self.curr_date = today.value
-        for asset in assets:  # asset is numpy.int64
-            self.time_index[asset] = self.bs_sparse_time(asset)
-
-    def update_time_index(self, today, assets):
-        """Ratchet update.
-
-        for each asset check if today >= dates[self.time_index]
-        if so then increment self.time_index[asset.sid] += 1"""
-
-        ind_p1 = self.time_index.copy()
-        np.add.at(ind_p1, ind_p1 != (self.M - 1), 1)
-        sids_to_increment = today.value >= self.data.date[np.arange(self.N), ind_p1]
-        sids_not_max = self.time_index != (self.M - 1)   # create mask of non-maxed
-        self.time_index[sids_to_increment & sids_not_max] += 1
-
-        self.curr_date = today.value
+        self.data_path = "please_specify_store_directory"
+
+    def __getattribute__(self, name):
+        outputs = object.__getattribute__(self, 'outputs')
+        if isinstance(outputs, (list, tuple)) and len(outputs) > 1 and name in outputs:
+            # the same single output factor is shared by all pipelines, terms are memoized by zipline
+            return getattr(type(self)(outputs=[name], mask=self.mask), name)
+        return super(SparseDataFactor, self).__getattribute__(name)
+
+    def output_location(self, output):
+        """Store directory and column holding an output"""
+        return self.data_path, output
 
     def compute(self, today, assets, out, *arrays):
-        # for each asset in assets determine index from date (today)
-        if self.time_index is None:
-            self.cold_start(today, assets)
-        else:
-            self.update_time_index(today, assets)
+        self.compute_outputs(today, assets, out, self.outputs)
+
+    def compute_outputs(self, today, assets, out, outputs):
+        located = {}
+        for output in outputs:
+            path, column = self.output_location(output)
 
-        ti_used_today = self.time_index[assets]
+            # for each asset in assets determine index from date (today), once per store
+            if path not in located:
+                cursor = get_cursor(path)
+                cursor.move_to(today.value)
+                located[path] = (cursor,) + cursor.positions(assets)
+            cursor, has_data, positions = located[path]
 
-        for field in self.__class__.outputs:
-            out[field][:] = self.data[field][assets, ti_used_today]
+            out[output][:] = self.fill_value
+            out[output][has_data] = cursor.store.column(column)[positions]
 
 
 class StaticData(CustomFactor):
     """Returns static values for an SID.
-    This holds static data (does not change with time) like: exchange, sector, category, industry"""
+    This holds static data (does not change with time) like: exchange, sector, category, industry.
+    The data is packed by load_static and memory-mapped once per process"""
     inputs = []
     window_length = 1
     outputs = ['sector', 'exchange', 'category', 'industry']
 
     def __init__(self, *args, **kwargs):
-        self.data = np.load(zipline_root() + '/data/' + 'SHARDAR_static.npy', allow_pickle=True)
+        self.data_path = zipline_root() + '/data/' + 'SHARDAR_static'
 
     def compute(self, today, assets, out):
-        # out[:] = self.data[assets]
-        out['sector'][:] = self.data[0, assets]
-        out['exchange'][:] = self.data[1, assets]
-        out['category'][:] = self.data[2, assets]
-        out['industry'][:] = self.data[3, assets]
+        data = get_columns(self.data_path)
+        # sids added after the data was packed are unknown
+        known = assets < data.num_sids
+        for output in self.outputs:
+            out[output][:] = -1
+            out[output][known] = data.column(output)[assets[known]]
+
+
+class Classification(SparseDataFactor):
+    """Returns the sector, exchange, category and industry codes of an SID in effect on each session, from
+    the classification history packed by load_static. Same codes as StaticData, -1 if unknown"""
+    outputs = ['sector', 'exchange', 'category', 'industry']
+    fill_value = -1
+
+    def __init__(self, *args, **kwargs):
+        super(Classification, self).__init__(*args, **kwargs)
+        self.data_path = zipline_root() + '/data/' + 'SHARDAR_static_history'
 
 
 class Fundamentals(SparseDataFactor):
+    """SF1 fundamentals packed by load_sf1. Outputs are read from the fields packed with the default
+    dimension selection. Outputs named <field>_<dimension>, e.g. pe_ART, are read from the fields packed
+    for that dimension with load_sf1(..., store_dimensions=[...]). Any packed field can be an output,
+    the class outputs are only the default selection:
+
+    Fundamentals(outputs=['marketcap', 'pe_ART', 'pe_MRQ', 'ebitda'])"""
     outputs = ['marketcap', 'assets', 'liabilities', 'pe', 'currentratio', 'netmargin', 'capex', 'fcf', 'roic']
 
     def __init__(self, *args, **kwargs):
         super(Fundamentals, self).__init__(*args, **kwargs)
-        self.N = len(get_ticker_sid_dict_from_bundle("sep")) + 1  # max(sid)+1 get this from the bundle
-        self.data_path = zipline_root() + '/data/' + 'SF1.npy'
+        self.data_path = zipline_root() + '/data/' + 'SF1'
+
+    def output_location(self, output):
+        field, _, dimension = output.rpartition('_')
+        if dimension in SF1_DIMENSIONS and field:
+            return os.path.join(self.data_path, dimension), field
+        return os.path.join(self.data_path, 'default'), output
+
+
+class PointInTimeFundamentals(Fundamentals):
+    """Fundamentals as known on each session, including later restatements only from the
+    time they became available. Packed by load_sf1 with point_in_time=True. Only the default
+    dimension selection is packed point in time, so <field>_<dimension> outputs are not available"""
+
+    def __init__(self, *args, **kwargs):
+        super(PointInTimeFundamentals, self).__init__(*args, **kwargs)
+        self.data_path = zipline_root() + '/data/' + 'SF1_pit'
+
+    def output_location(self, output):
+        path, column = super(PointInTimeFundamentals, self).output_location(output)
+        if os.path.basename(path) != 'default':
+            raise ValueError('Output {} is not available point in time, only the default dimension '
+                             'selection is packed into {}'.format(output, os.path.join(self.data_path, 'default')))
+        return path, column
+
+
+class DenseFundamentals(Fundamentals):
+    """Fundamentals read from the dense daily panels built by load_quandl_sf1.build_dense_panels, one row
+    slice per session. Sessions and outputs the panels do not cover, and stores written again after their
+    panel was built, are read from the sparse store, so results match Fundamentals up to float32 precision.
+    Meant for long backtests, where the panels trade disk for less work per session"""
+
+    def __init__(self, *args, **kwargs):
+        super(DenseFundamentals, self).__init__(*args, **kwargs)
+        self.dense_path = zipline_root() + '/data/' + 'SF1_dense'
+
+    def compute(self, today, assets, out, *arrays):
+        sparse = []
+        for output in self.outputs:
+            path, column = self.output_location(output)
+            panel = get_panel(os.path.join(self.dense_path, os.path.basename(path)), source=path)
+            row = panel.row(today.value) if panel is not None and panel.has_column(column) else -1
+            if row < 0:
+                sparse.append(output)
+                continue
+
+            # sids added after the panel was built have no data
+            known = assets < panel.num_sids
+            out[output][:] = np.nan
+            out[output][known] = panel.column(column)[row, assets[known]]
+
+        if sparse:
+            self.compute_outputs(today, assets, out, sparse)
@@ -1,9 +1,17 @@
 from qalphatools.loaders.bulk_quandl import download_quandl, get_newest_files
 from qalphatools.loaders.load_quandl_sep import ingest_sep
-from qalphatools.loaders.load_quandl_sf1 import load_sf1
+from qalphatools.loaders.load_quandl_sf1 import load_sf1, build_dense_panels
 from qalphatools.loaders.load_quandl_static import load_static
+from qalphatools.loaders.manifest import load_manifest, stage_inputs, stage_changed, record_stage, fingerprint
+from qalphatools.loaders.dag import Stage, run_stages
+from qalphatools.utils.registry import get_ticker_sid_dict
+from qalphatools.utils.bundle import latest_ingestion_path
+from qalphatools.utils.instrument import start_run, summarize
 
 import os
+import sys
+
+from zipline.utils.paths import zipline_root
 
 # Todo: Load these environment variables directly from a .env file
 os.environ['QUANDL_API_KEY'] = ''
@@ -12,20 +20,85 @@ os.environ['QUANDL_BASE_URL'] = 'https://www.quandl.com/api/v3/datatables/SHARAD
 
 TABLES = ['SEP', 'SF1', 'TICKERS']
 FIELDS = ['marketcap', 'assets', 'liabilities', 'pe', 'currentratio', 'netmargin', 'capex', 'fcf', 'roic']
+DIMENSIONS = ['ARQ', 'ART', 'MRQ', 'MRT', 'ARY']
+# first session of the dense daily SF1 panels read by DenseFundamentals. If None, the panels are not built
+DENSE_START = None
+# processes preparing the SEP bars of each ticker. Starting the pool costs about a second, about what one
+# process takes for a million rows, so daily deltas are faster in process. Raise it for full ingests on
+# machines with spare cores, batches under SEP_PARALLEL_ROWS rows are prepared in process anyway
+SEP_WORKERS = 1
+
+
+def refresh():
+    """
+    Refresh the SEP bundle, the SF1 stores and the static data from the latest Sharadar tables. SF1 and
+    TICKERS are packed while the SEP bars are written, as soon as the sids are registered. Stages whose
+    inputs did not change since the last run are skipped
+    :return: Dictionary with stage names as keys and Tuples (status, seconds) as values
+    """
+    # records of every stage of this run are appended to metrics.jsonl in $QUANDL_BASE
+    start_run()
+    # tables and stages of previous runs
+    manifest = load_manifest()
+    newest_files = {}
+
+    def download(signal):
+        # download SEP, SF1, TICKERS SHARADAR bulk tables from Quandl, skipping tables that were not refreshed
+        download_quandl(TABLES, manifest=manifest)
+        # get newest tables and delete old ones
+        newest_files.update(get_newest_files(TABLES))
+
+    def sep(signal):
+        # ingest SEP from bulk SEP table into Zipline, only processing rows updated since the last ingest
+        inputs = stage_inputs(manifest, ['SEP', 'TICKERS'])
+        outputs = [latest_ingestion_path('sep'), os.environ['QUANDL_BASE'] + 'sep_state/sep_state.json']
+        if not stage_changed(manifest, 'sep', inputs, outputs):
+            return 'skipped'
+        ingest_sep(newest_files, delta=True, on_registry=lambda ticker2sid: signal('sids'), workers=SEP_WORKERS)
+        record_stage(manifest, 'sep', inputs)
+
+    def sf1(signal):
+        # create Fundamental factors from bulk SF1 table
+        inputs = stage_inputs(manifest, ['SF1'], sids=fingerprint(get_ticker_sid_dict('sep')),
+                              config=fingerprint([FIELDS, DIMENSIONS, DENSE_START]))
+        outputs = [zipline_root() + '/data/' + 'SF1/{}/header.json'.format(store)
+                   for store in ['default'] + DIMENSIONS]
+        if not stage_changed(manifest, 'sf1', inputs, outputs):
+            return 'skipped'
+        load_sf1(newest_files['SF1'], FIELDS, dimensions=None, store_dimensions=DIMENSIONS)
+        record_stage(manifest, 'sf1', inputs)
+
+    def dense(signal):
+        # dense panels end on the last session, so they are rebuilt on every run
+        if DENSE_START is None:
+            return 'skipped'
+        build_dense_panels(DENSE_START)
+
+    def static(signal):
+        # create static data factor (sector, exchange, category, GICS)
+        inputs = stage_inputs(manifest, ['TICKERS'], sids=fingerprint(get_ticker_sid_dict('sep')))
+        outputs = [zipline_root() + '/data/' + store + '/header.json'
+                   for store in ['SHARDAR_static', 'SHARDAR_static_history']]
+        if not stage_changed(manifest, 'static', inputs, outputs):
+            return 'skipped'
+        load_static(newest_files['TICKERS'])
+        record_stage(manifest, 'static', inputs)
+
+    status = run_stages([Stage('download', download),
+                         Stage('sep', sep, requires=['download'], provides=['sids']),
+                         Stage('sf1', sf1, requires=['sids']),
+                         Stage('dense', dense, requires=['sf1']),
+                         Stage('static', static, requires=['sids'])])
+    summarize()
+    return status
+
 
 if __name__ == '__main__':
 
-    # download and unzip SEP, SF1, TICKERS SHARADAR bulk tables from Quandl
-    download_quandl(TABLES)
-    # get newest csv tables and delete old ones
-    newest_files = get_newest_files(TABLES)
-    # ingest SEP from bulk SEP table into Zipline
-    # Todo: Make sure ingest bash ends on Windows before proceeding to next function
-    ingest_sep(newest_files)
-    # create Fundamental factors from bulk SF1 table
-    load_sf1(newest_files['SF1'], FIELDS, dimensions=None)
-    # create static data factor (sector, exchange, category, GICS)
-    load_static(newest_files['TICKERS'])
+    status = refresh()
 
+    failed = sorted(name for name, (outcome, seconds) in status.items() if outcome in ('failed', 'blocked'))
+    if failed:
+        print('FAILED: {}'.format(', '.join(failed)))
+        sys.exit(1)
     print('DONE')
-
@@ -1,11 +1,129 @@
+import hashlib
 import json
 import sys
 import time
 import os
+import shutil
 import zipfile
+from multiprocessing.pool import ThreadPool
 
+from qalphatools.utils.table import convert_csv, read_header
+from qalphatools.loaders.manifest import save_manifest
+from qalphatools.utils.instrument import measure
 
-def bulk_fetch(url, dest_file_ref):
+if sys.version_info[0] < 3:
+    from urllib2 import urlopen, Request, URLError, HTTPError
+    from httplib import HTTPException
+else:
+    from urllib.request import urlopen, Request
+    from urllib.error import URLError, HTTPError
+    from http.client import HTTPException
+
+
+CHUNK_SIZE = 1 << 20  # bytes read and written at a time while downloading
+TIMEOUT = 60  # seconds without data before a connection is considered dropped
+MAX_RETRIES = 8  # failed requests in a row before giving up
+POLL_INTERVAL = 5  # first wait in seconds while a bulk file is generated, doubled after every poll
+MAX_POLL_INTERVAL = 300
+
+
+def with_backoff(fn, max_retries=MAX_RETRIES, interval=POLL_INTERVAL, max_interval=MAX_POLL_INTERVAL):
+    """
+    Call fn until it succeeds, waiting exponentially longer after each network error. Client errors, e.g. a
+    rejected API key, are raised at once, except 429 Too Many Requests
+    :param fn: function without arguments
+    :return: value returned by fn
+    """
+    for attempt in range(max_retries):
+        try:
+            return fn()
+        except (URLError, IOError, HTTPException) as e:
+            if isinstance(e, HTTPError) and 400 <= e.code < 500 and e.code != 429:
+                raise
+            if attempt == max_retries - 1:
+                raise
+            wait = min(interval * 2 ** attempt, max_interval)
+            print('request failed ({}), retrying in {}s'.format(e, wait))
+            time.sleep(wait)
+
+
+def get_bulk_link(url, interval=POLL_INTERVAL, max_interval=MAX_POLL_INTERVAL):
+    """
+    Poll the bulk download API until the file of a table is ready, waiting exponentially longer between polls
+    :param url: URL to get full Sharadar table from
+    :return: Tuple (link, last_refreshed_time) with the link to the zip file and the refresh time of the table
+    """
+    valid = ['fresh', 'regenerating']
+    wait = interval
+    while True:
+        Dict = with_backoff(lambda: json.loads(urlopen(url, timeout=TIMEOUT).read().decode('utf-8')))
+        last_refreshed_time = Dict['datatable_bulk_download']['datatable']['last_refreshed_time']
+        status = Dict['datatable_bulk_download']['file']['status']
+        link = Dict['datatable_bulk_download']['file']['link']
+        print(status)
+        if status in valid:
+            return link, last_refreshed_time
+        time.sleep(wait)
+        wait = min(wait * 2, max_interval)
+
+
+def download_file(link, dest_file_ref, chunk_size=CHUNK_SIZE, max_retries=MAX_RETRIES, version=None):
+    """
+    Stream a file to disk in chunks, so memory use does not depend on the file size. The data is written
+    to a .part file next to dest_file_ref, and a dropped connection resumes from the bytes already written
+    with an HTTP range request. Servers that ignore the range send the whole file again, and a range the
+    server cannot satisfy starts the download over. The .part file is named after the version of the file,
+    and .part files of other versions are deleted, so a download is never resumed from the bytes of another
+    file
+    :param link: URL of the file
+    :param dest_file_ref: destination file, only created once the download completes
+    :param version: version of the file, e.g. the last refreshed time of the table
+    """
+    folder, name = os.path.split(os.path.abspath(dest_file_ref))
+    version = '' if version is None else '.' + ''.join(c if c.isalnum() else '_' for c in str(version))
+    part_file = os.path.join(folder, name + version + '.part')
+
+    for file in os.listdir(folder):
+        stale = os.path.join(folder, file)
+        if file.startswith(name) and file.endswith('.part') and stale != part_file:
+            os.remove(stale)
+            print('Removed stale partial download: ', stale)
+
+    def fetch():
+        offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+        request = Request(link)
+        if offset:
+            request.add_header('Range', 'bytes=%d-' % offset)
+        try:
+            response = urlopen(request, timeout=TIMEOUT)
+        except HTTPError as e:
+            if e.code != 416 or not offset:
+                raise
+            # the bytes written do not fit the file, start over without a range
+            print('cannot resume %s from byte %d, starting over' % (link, offset))
+            os.remove(part_file)
+            return fetch()
+        if offset and response.getcode() != 206:
+            offset = 0
+        if offset:
+            print('resuming %s from byte %d' % (link, offset))
+
+        length = response.info().get('Content-Length')
+        with open(part_file, 'ab' if offset else 'wb') as f:
+            while True:
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    break
+                f.write(chunk)
+        if length is not None and os.path.getsize(part_file) != offset + int(length):
+            raise IOError('connection dropped after %d of %d bytes' % (os.path.getsize(part_file),
+                                                                      offset + int(length)))
+
+    with_backoff(fetch, max_retries=max_retries)
+    os.rename(part_file, dest_file_ref)
+
+
+def bulk_fetch(url, dest_file_ref, known_refreshed_time=None):
     """
     Code adapted from http://www.sharadar.com/meta/bulk_fetch.py
     :param url: URL to get full Sharadar table from. You can specify different tables (SF1, SEP,...)
@@ -14,61 +132,101 @@ def bulk_fetch(url, dest_file_ref):
     optionally add parameters to the url to filter the data retrieved, as described in the associated table's
      documentation, eg here: https://www.quandl.com/databases/SF1/documentation/getting-started
     :param dest_file_ref: destination that you would like the retrieved data to be saved to
+    :param known_refreshed_time: last refreshed time of the copy of the table already downloaded. If the table
+    was not refreshed since, nothing is fetched
+    :return: last refreshed time of the table
     """
-    version = sys.version.split(' ')[0]
-    if version < '3':
-        import urllib2
-        fn = urllib2.urlopen
-    else:
-        import urllib
-        fn = urllib.request.urlopen
-
-    valid = ['fresh', 'regenerating']
-    status = ''
-    while status not in valid:
-        Dict = json.loads(fn(url).read().decode('utf-8'))
-        last_refreshed_time = Dict['datatable_bulk_download']['datatable']['last_refreshed_time']
-        status = Dict['datatable_bulk_download']['file']['status']
-        link = Dict['datatable_bulk_download']['file']['link']
-        print(status)
-        if status not in valid:
-            time.sleep(60)
+    link, last_refreshed_time = get_bulk_link(url)
+    if known_refreshed_time is not None and last_refreshed_time == known_refreshed_time:
+        print('not refreshed since %s, skipping %s' % (last_refreshed_time, link))
+        return last_refreshed_time
 
     print('fetching from %s' % link)
-    zipString = fn(link).read()
-    f = open(dest_file_ref, 'wb')
-    f.write(zipString)
-    f.close()
+    download_file(link, dest_file_ref, version=last_refreshed_time)
     print('fetched')
+    return last_refreshed_time
+
+
+class HashingReader(object):
+    """File object wrapper that hashes the bytes read through it"""
+    def __init__(self, f, digest):
+        self.f = f
+        self.digest = digest
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.digest.update(data)
+        return data
 
 
-def download_quandl(tables):
+def fetch_table(table, base_download, known=None):
     """
-    Download and unzip Sharadar tables from Quandl
-    :param tables: List of strings, specifying tables to download
+    Download one Sharadar table and convert it to a table directory
+    :param table: table to download
+    :param base_download: directory to write the table to
+    :param known: manifest entry of the table, as returned by this function, for the last download. If the
+    table was not refreshed since and its table directory is still there, it is not downloaded again
+    :return: Dictionary with the last_refreshed_time of the table, the sha256 hash of its csv content and the
+    path of its table directory
     """
-    base_download = os.environ['QUANDL_BASE'] + 'data_downloads/'
-    dest_file_ref = [base_download + t + '_download.csv.zip' for t in tables]
-    base_url = os.environ['QUANDL_BASE_URL']
+    dest = base_download + table + '_download.csv.zip'
+    url = os.environ['QUANDL_BASE_URL'] % (table, os.environ['QUANDL_API_KEY'])
+    known_refreshed_time = known['last_refreshed_time'] if known and os.path.exists(known['path']) else None
+    with measure('download', table=table) as m:
+        last_refreshed_time = bulk_fetch(url, dest, known_refreshed_time)
+        m['skipped'] = not os.path.exists(dest)
+        m['zip_mb'] = None if m['skipped'] else round(os.path.getsize(dest) / 2. ** 20, 1)
+    if not os.path.exists(dest):
+        return known
 
-    for table, dest in zip(tables, dest_file_ref):
+    # parse each csv once, streamed from the zip into a table of typed columns read by the loaders
+    digest = hashlib.sha256()
+    with measure('convert', table=table) as m:
+        m['zip_mb'] = round(os.path.getsize(dest) / 2. ** 20, 1)
+        with zipfile.ZipFile(dest, "r") as zip_ref:
+            for member in sorted(zip_ref.namelist()):
+                path = base_download + os.path.splitext(os.path.basename(member))[0]
+                with zip_ref.open(member) as f:
+                    convert_csv(HashingReader(f, digest), path)
+        m['rows_out'] = read_header(path)['num_rows']
+        print("Converted: ", dest)
 
-        url = base_url % (table, os.environ['QUANDL_API_KEY'])
-        bulk_fetch(url, dest)
+    os.remove(dest)
+    print("Removed zip file: ", dest)
+    return {'last_refreshed_time': last_refreshed_time, 'hash': digest.hexdigest(), 'path': path}
 
-        with zipfile.ZipFile(dest, "r") as zip_ref:
-            zip_ref.extractall(base_download)
-            print("Unzipped: ", dest)
 
-        os.remove(dest)
-        print("Removed zip file: ", dest)
+def download_quandl(tables, workers=None, manifest=None):
+    """
+    Download Sharadar tables from Quandl, all tables at once, and convert them to table directories
+    :param tables: List of strings, specifying tables to download
+    :param workers: number of tables downloaded at the same time. If None, all of them
+    :param manifest: Manifest, as returned by load_manifest. If provided, tables not refreshed since the last
+    download are skipped, and the manifest is updated and saved
+    :return: Dictionary with tables as keys and their manifest entries, as returned by fetch_table, as values
+    """
+    base_download = os.environ['QUANDL_BASE'] + 'data_downloads/'
+    known = manifest['tables'] if manifest is not None else {}
+    pool = ThreadPool(workers or len(tables))
+    try:
+        results = [pool.apply_async(fetch_table, (table, base_download, known.get(table))) for table in tables]
+        entries = dict(zip(tables, [r.get() for r in results]))
+    finally:
+        pool.close()
+        pool.join()
+
+    if manifest is not None:
+        manifest['tables'].update(entries)
+        save_manifest(manifest)
+    return entries
 
 
 def get_newest_files(tables):
     """
     Find latest bulk file for each table and delete old files
     :param tables: List of strings
-    :return: Dictionary with strings as key specifying a table, and the path of the latest file for each table
+    :return: Dictionary with strings as key specifying a table, and the path of the latest table directory, or
+    csv file, for each table
     """
 
     base_download = os.environ['QUANDL_BASE'] + 'data_downloads/'
@@ -79,7 +237,8 @@ def get_newest_files(tables):
 
         current_files = []
         for file in os.listdir(base_download):
-            if file.startswith('SHARADAR_' + table):
+            # skip tables still being written or replaced
+            if file.startswith('SHARADAR_' + table) and not file.endswith(('.tmp', '.old')):
                 current_files.append(file)
 
         newest_files[table] = max([base_download + c for c in current_files], key=os.path.getctime)
@@ -87,7 +246,10 @@ def get_newest_files(tables):
         if len(current_files) > 1:
             for cf in current_files:
                 if base_download + cf != newest_files[table]:
-                    os.remove(base_download + cf)
+                    if os.path.isdir(base_download + cf):
+                        shutil.rmtree(base_download + cf)
+                    else:
+                        os.remove(base_download + cf)
                     print("Removed old file: ", base_download + cf)
 
     return newest_files
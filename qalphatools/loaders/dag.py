@@ -0,0 +1,91 @@
+import threading
+import time
+import traceback
+
+from qalphatools.utils.instrument import measure
+
+
+class Stage(object):
+    """
+    A step of the loader pipeline
+
+    :param name: name of the stage, completed once fn returns
+    :param fn: function called with a signal function. signal(event) marks one of provides as completed
+    before fn returns, so stages waiting for it can start. fn may return 'skipped' if it had nothing to do
+    :param requires: names of the stages and events that must complete before the stage starts
+    :param provides: events completed by the stage, at the latest when it returns
+    """
+    def __init__(self, name, fn, requires=(), provides=()):
+        self.name = name
+        self.fn = fn
+        self.requires = list(requires)
+        self.provides = list(provides)
+
+
+def run_stages(stages):
+    """
+    Run the stages of a pipeline, each in its own thread as soon as the stages and events it requires
+    completed. Stages that require a failed stage, or an event a failed stage did not complete, are blocked
+
+    :param stages: List of Stage
+    :return: Dictionary with stage names as keys and Tuples (status, seconds) as values, where status is one of
+    'done', 'skipped', 'failed' or 'blocked'
+    """
+    condition = threading.Condition()
+    completed, failed = set(), set()
+    status, running = {}, {}
+    start = time.time()
+
+    def signal(event):
+        with condition:
+            completed.add(event)
+            condition.notify_all()
+
+    def run(stage):
+        t0 = time.time()
+        try:
+            with measure('stage.' + stage.name) as m:
+                result = stage.fn(signal)
+                m['outcome'] = 'skipped' if result == 'skipped' else 'done'
+            outcome = m['outcome']
+        except Exception:
+            print("stage {} failed:".format(stage.name))
+            traceback.print_exc()
+            outcome = 'failed'
+
+        with condition:
+            status[stage.name] = (outcome, time.time() - t0)
+            if outcome == 'failed':
+                failed.update([stage.name] + [p for p in stage.provides if p not in completed])
+            else:
+                completed.update([stage.name] + stage.provides)
+            del running[stage.name]
+            condition.notify_all()
+        print("stage {} {} in {:.1f}s".format(stage.name, outcome, status[stage.name][1]))
+
+    pending = list(stages)
+    with condition:
+        while pending or running:
+            for stage in list(pending):
+                if any(r in failed for r in stage.requires):
+                    pending.remove(stage)
+                    failed.update([stage.name] + stage.provides)
+                    status[stage.name] = ('blocked', 0.0)
+                    print("stage {} blocked".format(stage.name))
+                elif all(r in completed for r in stage.requires):
+                    pending.remove(stage)
+                    print("stage {} started after {:.1f}s".format(stage.name, time.time() - start))
+                    running[stage.name] = threading.Thread(target=run, args=(stage,), name=stage.name)
+                    running[stage.name].start()
+
+            if pending and not running and not any(all(r in completed for r in s.requires) for s in pending):
+                # nothing left can satisfy the remaining requirements
+                for stage in pending:
+                    status[stage.name] = ('blocked', 0.0)
+                    print("stage {} blocked".format(stage.name))
+                break
+            if pending or running:
+                condition.wait()
+
+    print("pipeline finished in {:.1f}s".format(time.time() - start))
+    return status
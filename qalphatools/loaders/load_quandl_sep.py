@@ -1,32 +1,434 @@
 # Code adapted from https://github.com/pbharrin/alpha-compiler/tree/master/alphacompiler
 
+import numpy as np
 import pandas as pd
-import sys
+import json
 import os
-import subprocess
+import shutil
+from functools import partial
+import multiprocessing
 
+from qalphatools.utils.registry import SidRegistry
+from qalphatools.utils.store import _replace_dir
+from qalphatools.utils.table import is_table, iter_table, read_table, table_tickers
+from qalphatools.utils.instrument import measure
+
+from zipline.data.bundles import ingest, register
 from zipline.utils.calendars import get_calendar
 
 
-def check_for_abnormal_returns(df, thresh=3.0):
-    """Checks to see if any days have abnormal returns"""
-    returns = df['close'].pct_change()
-    abnormal_rets = returns[returns > thresh]
-    if abnormal_rets.shape[0] > 0:
-        sys.stderr.write('Abnormal returns for: {}\n'.format(df.ix[0]['ticker']))
-        sys.stderr.write('{}\n'.format(str(abnormal_rets)))
+# only the columns needed by the bar and adjustment writers are parsed from the SEP dump
+SEP_COLUMNS = ['ticker', 'date', 'open', 'high', 'low', 'close', 'volume', 'dividends', 'lastupdated']
+SEP_DTYPES = {'ticker': str,
+              'open': np.float64,
+              'high': np.float64,
+              'low': np.float64,
+              'close': np.float64,
+              'volume': np.float64,
+              'dividends': np.float64}
+# rough upper bound of the memory used per row while a chunk of the SEP dump is parsed, or while a batch of
+# tickers is read, prepared and written
+SEP_ROW_BYTES = 256
+REPORT_COLUMNS = ['ticker', 'date', 'issue', 'value']
+SEP_STATE_VERSION = 3
+# fewer rows are prepared in process, a pool of workers takes longer to start than to prepare them
+SEP_PARALLEL_ROWS = 2000000
+
+
+def read_sep_chunked(file_name, tickers=None, max_memory_mb=512, since=None):
+    """
+    Stream the SEP bulk file in chunks and collect bars and dividends in a single pass.
+    Only the columns in SEP_COLUMNS are parsed, with explicit dtypes, so the retained data is a
+    fraction of the size of a full read_csv of the dump. The chunks are concatenated, so the bars of
+    all kept tickers are held in memory at once
+
+    :param file_name: SEP table directory converted by convert_csv, or CSV SEP file retrieved from Quandl
+    :param tickers: Iterable of tickers to keep. If None, keep all tickers
+    :param max_memory_mb: Approximate size in MB of the parse buffer of a single chunk, used to size the chunks.
+    It does not bound the memory of the returned DataFrames
+    :param since: Timestamp. If provided, only keep rows with lastupdated on or after this timestamp
+    :return: Tuple of DataFrames (bars, dividends). bars has columns ticker, open, high, low, close, volume,
+    lastupdated and dividends has columns ticker, dividends. Both are indexed by date
+    """
+    chunksize = max(1, int(max_memory_mb * 2 ** 20 / SEP_ROW_BYTES))
+    if tickers is not None:
+        tickers = set(tickers)
+
+    if is_table(file_name):
+        # already typed and partitioned by ticker, only the rows of the kept tickers are read
+        reader = iter_table(file_name, columns=SEP_COLUMNS, tickers=tickers, chunk_rows=chunksize)
+    else:
+        reader = pd.read_csv(file_name, usecols=SEP_COLUMNS, dtype=SEP_DTYPES,
+                             parse_dates=['date', 'lastupdated'], na_values=['NA'], chunksize=chunksize)
+
+    bars, dividends = [], []
+    for chunk in reader:
+        if tickers is not None:
+            chunk = chunk[chunk.ticker.isin(tickers)]
+        if since is not None:
+            chunk = chunk[chunk.lastupdated >= since]
+
+        # keep rows where dividends != 0.0, dividends will be written by the adjustment writer
+        div = chunk[chunk['dividends'] != 0.0].dropna(subset=['ticker', 'date', 'dividends'])
+        dividends.append(div[['ticker', 'date', 'dividends']])
+        bars.append(chunk.drop(['dividends'], axis=1))
+
+    if not bars:
+        # none of the kept tickers is in the table
+        empty = pd.DataFrame({c: np.array([], dtype=SEP_DTYPES.get(c, 'datetime64[ns]')) for c in SEP_COLUMNS})
+        bars, dividends = [empty.drop(['dividends'], axis=1)], [empty[['ticker', 'date', 'dividends']]]
+
+    bars = pd.concat(bars, ignore_index=True).set_index('date')
+    dividends = pd.concat(dividends, ignore_index=True).set_index('date')
+
+    return bars, dividends
+
+
+def find_abnormal_returns(df, thresh=3.0):
+    """
+    Find days with abnormal returns for all tickers at once
+
+    :param df: DataFrame with columns ticker, date and close, sorted by ticker and date
+    :param thresh: Returns above this threshold are flagged as abnormal
+    :return: DataFrame with columns ticker, date, issue, value
+    """
+    close = df['close'].values
+    ticker = df['ticker'].values
+
+    returns = np.full(close.shape[0], np.nan)
+    if close.shape[0] > 1:
+        same_ticker = ticker[1:] == ticker[:-1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            returns[1:] = np.where(same_ticker, close[1:] / close[:-1] - 1., np.nan)
+
+    abnormal = returns > thresh
+    return pd.DataFrame({'ticker': ticker[abnormal],
+                         'date': df['date'].values[abnormal],
+                         'issue': 'abnormal_return',
+                         'value': returns[abnormal]},
+                        columns=REPORT_COLUMNS)
+
+
+def segment_bounds(keys):
+    """
+    Boundaries of runs of equal keys in a sorted array
+
+    :param keys: Sorted numpy array
+    :return: Tuple (unique keys, start positions, end positions)
+    """
+    if keys.shape[0] == 0:
+        return keys, np.zeros(0, np.int64), np.zeros(0, np.int64)
+    starts = np.concatenate([[0], np.flatnonzero(keys[1:] != keys[:-1]) + 1])
+    ends = np.concatenate([starts[1:], [keys.shape[0]]])
+    return keys[starts], starts, ends
+
+
+def align_to_sessions(df, sessions, thresh=3.0):
+    """
+    Reindex every ticker to the trading sessions between its first and last bar, forward fill
+    interstitial gaps and flag abnormal returns, for the whole panel in one vectorized stage
+
+    :param df: DataFrame indexed by date with columns ticker, open, high, low, close, volume
+    :param sessions: tz-naive DatetimeIndex with the trading sessions of the calendar
+    :param thresh: Returns above this threshold are flagged as abnormal
+    :return: Tuple (panel, report). panel has columns ticker, date, open, high, low, close, volume, sorted
+    by ticker and date. report is a DataFrame with columns ticker, date, issue, value, where issue is
+    'missing_session' for forward filled sessions or 'abnormal_return'
+    """
+    df = df.reset_index().sort_values(['ticker', 'date'], kind='mergesort')
+    df = df.drop_duplicates(['ticker', 'date'], keep='last')
+
+    abnormal = find_abnormal_returns(df, thresh=thresh)
+
+    # sessions between the first and last bar of each ticker
+    tickers, starts, ends = segment_bounds(df['ticker'].values)
+    dates = df['date'].values
+    first = sessions.searchsorted(dates[starts], side='left')
+    last = sessions.searchsorted(dates[ends - 1], side='right')
+    lengths = np.maximum(last - first, 0)
+
+    offsets = np.cumsum(lengths) - lengths
+    positions = np.arange(lengths.sum()) - np.repeat(offsets - first, lengths)
+    index = pd.MultiIndex.from_arrays([np.repeat(tickers, lengths), sessions[positions]],
+                                      names=['ticker', 'date'])
+
+    df['present'] = True
+    panel = df.set_index(['ticker', 'date']).reindex(index)
+    missing = panel['present'].isnull().values
+    panel = panel.drop(['present'], axis=1).groupby(level=0, sort=False).ffill()
+    panel = panel.reset_index()
+
+    gaps = pd.DataFrame({'ticker': panel['ticker'].values[missing],
+                         'date': panel['date'].values[missing],
+                         'issue': 'missing_session',
+                         'value': np.nan},
+                        columns=REPORT_COLUMNS)
+
+    report = pd.concat([gaps, abnormal], ignore_index=True)
+    report = report.sort_values(['ticker', 'date'], kind='mergesort').reset_index(drop=True)
+
+    return panel, report
+
+
+def prepare_panel(df, sessions, workers=1, thresh=3.0):
+    """
+    Run align_to_sessions over contiguous ranges of tickers in a process pool. Tickers are independent, so
+    the partitions are concatenated back in ticker order and the output does not depend on the number of workers
+
+    :param df: DataFrame indexed by date with columns ticker, open, high, low, close, volume
+    :param sessions: tz-naive DatetimeIndex with the trading sessions of the calendar
+    :param workers: Number of worker processes. If 1, or df has fewer than SEP_PARALLEL_ROWS rows, run in the
+    current process
+    :param thresh: Returns above this threshold are flagged as abnormal
+    :return: Tuple (panel, report), as returned by align_to_sessions
+    """
+    if workers is None or workers <= 1 or df.shape[0] < SEP_PARALLEL_ROWS:
+        return align_to_sessions(df, sessions, thresh=thresh)
+
+    df = df.sort_values('ticker', kind='mergesort')
+    _, starts, _ = segment_bounds(df['ticker'].values)
+
+    # cut at the ticker boundaries closest to equal sized partitions
+    targets = np.arange(1, workers) * df.shape[0] / float(workers)
+    cuts = np.unique(np.concatenate([[0], starts[np.searchsorted(starts, targets).clip(0, len(starts) - 1)],
+                                     [df.shape[0]]]))
+    partitions = [df.iloc[a:b] for a, b in zip(cuts[:-1], cuts[1:]) if b > a]
+
+    # workers are started fresh rather than forked, the ingest runs next to other loader threads
+    context = multiprocessing.get_context('spawn') if hasattr(multiprocessing, 'get_context') else multiprocessing
+    pool = context.Pool(workers)
+    try:
+        results = pool.map(partial(align_to_sessions, sessions=sessions, thresh=thresh), partitions)
+    finally:
+        pool.close()
+        pool.join()
+
+    panel = pd.concat([r[0] for r in results], ignore_index=True)
+    report = pd.concat([r[1] for r in results], ignore_index=True)
+
+    return panel, report
+
 
+def _row_keys(df):
+    """MultiIndex of (ticker, date) pairs of a DataFrame with ticker and date columns"""
+    return pd.MultiIndex.from_arrays([df['ticker'].values, df['date'].values])
 
-def from_sep_dump(file_name, ticker_file_name=None, start=None, end=None):
+
+def _drop_unchanged(delta, panel, report):
+    """Rows of delta that are not identical to a bar of the panel that was not forward filled"""
+    recent = panel[panel['date'].values >= delta['date'].min()] if delta.shape[0] else panel.iloc[:0]
+    filled = report[(report.issue == 'missing_session').values]
+    bars = recent[~_row_keys(recent).isin(_row_keys(filled))]
+
+    merged = delta.merge(bars, on=['ticker', 'date'], how='left', suffixes=('', '_old'), indicator=True)
+    same = (merged['_merge'] == 'both').values.copy()
+    for name in ['open', 'high', 'low', 'close', 'volume']:
+        new, old = merged[name].values, merged[name + '_old'].values
+        same &= (new == old) | (np.isnan(new) & np.isnan(old))
+
+    return delta[~same]
+
+
+def merge_delta(panel, report, delta, sessions, workers=1, thresh=3.0):
+    """
+    Update a prepared panel with new or revised bars. Tickers whose new bars all come after their last
+    session only have the new sessions prepared. Tickers with revised history are prepared again from
+    their raw bars, the panel without its forward filled sessions. Rows identical to a bar already in the
+    panel, e.g. the rows read again at the lastupdated of the previous ingest, are not revisions
+
+    :param panel: DataFrame with the prepared bars of the previous ingest, as returned by align_to_sessions
+    :param report: DataFrame with the report of the previous ingest, as returned by align_to_sessions
+    :param delta: DataFrame indexed by date with columns ticker, open, high, low, close, volume, with the
+    new or revised rows
+    :param sessions: tz-naive DatetimeIndex with the trading sessions of the calendar
+    :param workers: Number of worker processes, see prepare_panel
+    :param thresh: Returns above this threshold are flagged as abnormal
+    :return: Tuple (panel, report), as returned by align_to_sessions
+    """
+    delta = _drop_unchanged(delta.reset_index(), panel, report)
+
+    tickers, starts, ends = segment_bounds(panel['ticker'].values)
+    last = pd.Series(panel['date'].values[ends - 1], index=tickers)
+    first_new = delta.groupby('ticker')['date'].min()
+    last_old = last.reindex(first_new.index)
+
+    revised = set(first_new.index[(first_new <= last_old).values])
+    appended = set(first_new.index) - revised
+
+    is_revised = panel['ticker'].isin(revised).values
+    is_appended = panel['ticker'].isin(appended).values
+    panels = [panel[~is_revised]]
+    reports = [report[~report['ticker'].isin(revised).values]]
+
+    # revised tickers: raw bars are the panel rows that were not forward filled, with the delta on top
+    if revised:
+        old = panel[is_revised]
+        filled = report[(report.issue == 'missing_session').values & report['ticker'].isin(revised).values]
+        old = old[~_row_keys(old).isin(_row_keys(filled))]
+        new = delta[delta['ticker'].isin(revised).values]
+        raw = pd.concat([old[~_row_keys(old).isin(_row_keys(new))], new], ignore_index=True)
+
+        p, r = prepare_panel(raw.set_index('date'), sessions, workers=workers, thresh=thresh)
+        panels.append(p)
+        reports.append(r)
+
+    # appended tickers: prepare the new bars together with the last session already in the panel
+    if appended:
+        tail = panel.iloc[ends - 1]
+        tail = tail[tail['ticker'].isin(appended).values]
+        new = delta[delta['ticker'].isin(appended).values]
+
+        p, r = prepare_panel(pd.concat([tail, new], ignore_index=True).set_index('date'),
+                             sessions, workers=workers, thresh=thresh)
+        p_last = last.reindex(p['ticker'].values).values
+        r_last = last.reindex(r['ticker'].values).values
+        panels.append(p[~(p['date'].values <= p_last)])
+        reports.append(r[~(r['date'].values <= r_last)])
+
+    panel = pd.concat(panels, ignore_index=True)
+    panel = panel.sort_values(['ticker', 'date'], kind='mergesort').reset_index(drop=True)
+    report = pd.concat(reports, ignore_index=True)
+    report = report.sort_values(['ticker', 'date'], kind='mergesort').reset_index(drop=True)
+
+    return panel, report
+
+
+def plan_batches(tickers, rows, max_rows):
+    """
+    Split tickers into batches of whole tickers, in the given order
+
+    :param tickers: sequence of tickers
+    :param rows: number of rows of each ticker
+    :param max_rows: rows per batch, a batch holds more rows if a single ticker does
+    :return: List of lists of tickers
+    """
+    batches, batch, size = [], [], 0
+    for ticker, n in zip(tickers, rows):
+        if batch and size + n > max_rows:
+            batches.append(batch)
+            batch, size = [], 0
+        batch.append(ticker)
+        size += n
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def load_sep_state(state_dir):
+    """
+    Load the state saved by the last ingest that used state_dir. The prepared bars are saved in batches of
+    tickers, read one at a time with load_sep_batch
+
+    :param state_dir: Directory with the saved state
+    :return: Dictionary with keys lastupdated and batches, the list of the tickers of each saved batch,
+    or None if there is no saved state
+    """
+    state_file = os.path.join(state_dir, 'sep_state.json')
+    if not os.path.exists(state_file):
+        return None
+
+    with open(state_file) as f:
+        state = json.load(f)
+    if state.get('version') != SEP_STATE_VERSION:
+        print("Ignoring SEP state with version {}".format(state.get('version')))
+        return None
+
+    state['lastupdated'] = pd.Timestamp(state['lastupdated'])
+    return state
+
+
+def load_sep_batch(state_dir, i):
+    """
+    :param state_dir: Directory with the saved state
+    :param i: position of the batch in the batches of the state
+    :return: Tuple (panel, report, dividends) of the tickers of the batch, as saved by save_sep_batch
+    """
+    return tuple(pd.read_pickle(os.path.join(state_dir, 'sep_{}_{}.pkl'.format(name, i)))
+                 for name in ['panel', 'report', 'dividends'])
+
+
+def save_sep_batch(state_dir, i, panel, report, dividends):
+    """
+    Save the prepared bars of a batch of tickers, used as the starting point of the next delta ingest
+
+    :param state_dir: Directory to save the state to
+    :param i: position of the batch in the batches of the state
+    :param panel: DataFrame with the prepared bars, as returned by align_to_sessions
+    :param report: DataFrame with the report, as returned by align_to_sessions
+    :param dividends: DataFrame with the dividends, as returned by read_sep_chunked
+    """
+    panel.to_pickle(os.path.join(state_dir, 'sep_panel_{}.pkl'.format(i)))
+    report.to_pickle(os.path.join(state_dir, 'sep_report_{}.pkl'.format(i)))
+    dividends.to_pickle(os.path.join(state_dir, 'sep_dividends_{}.pkl'.format(i)))
+
+
+def save_sep_state(state_dir, lastupdated, batches):
+    """
+    Mark the batches saved with save_sep_batch as a complete state
+
+    :param state_dir: Directory to save the state to
+    :param lastupdated: Timestamp of the newest lastupdated value ingested
+    :param batches: List with the tickers of each saved batch
+    """
+    # the json file is written last, it marks the state as complete
+    state = {'version': SEP_STATE_VERSION,
+             'lastupdated': str(lastupdated),
+             'batches': [list(batch) for batch in batches]}
+    with open(os.path.join(state_dir, 'sep_state.json'), 'w') as f:
+        json.dump(state, f)
+
+
+def format_dividends(dividends, ticker2sid_map):
+    """
+    Format dividend rows for the Zipline adjustment writer, attaching sids with a vectorized lookup
+
+    :param dividends: DataFrame indexed by date with columns ticker and dividends, as returned by read_sep_chunked
+    :param ticker2sid_map: Dictionary with tickers as keys and sids as values. Tickers not in the map are dropped
+    :return: DataFrame with columns sid, amount, ex_date, record_date, declared_date, pay_date
+    """
+    sids = dividends['ticker'].map(ticker2sid_map)
+    dividends = dividends[sids.notnull()]
+    dates = dividends.index
+
+    return pd.DataFrame({'sid': sids[sids.notnull()].values.astype(np.int64),
+                         'amount': dividends['dividends'].values,
+                         'ex_date': dates,
+                         'record_date': dates,
+                         'declared_date': dates,
+                         'pay_date': dates},
+                        index=dates,
+                        columns=['sid', 'amount', 'ex_date', 'record_date', 'declared_date', 'pay_date'])
+
+
+def from_sep_dump(file_name, ticker_file_name=None, start=None, end=None, max_memory_mb=512, report_file=None,
+                  workers=1, state_dir=None, delta=None, registry_file=None, on_registry=None):
     """
     Wrapper for ingest function. Ingest Sharadar SEP bulk file into Zipline
 
-    :param file_name: CSV SEP file retrieved from Quandl
-    :param ticker_file_name: CSV TICKERS file retrieved from Quandl. If provided,
+    :param file_name: SEP table directory, or CSV SEP file retrieved from Quandl
+    :param ticker_file_name: TICKERS table directory, or CSV TICKERS file retrieved from Quandl. If provided,
     remove ADRs, Warrants, ETFs, micro-caps and companies de-listed post 2016. If None,
     process the full SEP file
     :param start: start date
     :param end: end date
+    :param max_memory_mb: Memory cap in MB for the bars held at a time. A SEP table directory is read, prepared,
+    saved and written in batches of whole tickers of about max_memory_mb * 2 ** 20 / SEP_ROW_BYTES rows, so the
+    peak memory does not grow with the size of the dump. A delta ingest holds the new or revised rows and one
+    saved batch at a time. A CSV SEP file is not partitioned by ticker, it is parsed in chunks of that size but
+    its kept rows are held whole. The dividends of all tickers are collected for the adjustment writer
+    :param report_file: CSV file to save the report of forward filled sessions and abnormal returns. If None,
+    only a summary is printed
+    :param workers: Number of processes used to prepare the bars of each ticker before writing
+    :param state_dir: Directory where the prepared bars are saved after each ingest. If None, use the
+    SEP_STATE_DIR environment variable if set
+    :param delta: If True and a saved state exists, only process rows with a lastupdated value on or after the
+    one of the previous ingest, and merge them into the saved batches of bars. Tickers that are not in the saved
+    batches yet are prepared from their full history in new batches. Tickers no longer in the ticker filter are
+    dropped. If None, use the SEP_DELTA environment variable
+    :param registry_file: Ticker/sid registry file. Sids already in the registry are kept and new tickers are
+    registered. If None, use the registry of the sep bundle
+    :param on_registry: Function called with the ticker to sid dictionary once the registry is saved, before
+    the bars are written, so work that only needs the sids can start
     :return: ingest function for Zipline
     """
     us_calendar = get_calendar("NYSE").all_sessions
@@ -49,106 +451,206 @@ def from_sep_dump(file_name, ticker_file_name=None, start=None, end=None):
 
             print("Filtering ticker space")
 
-            df_ticker = pd.read_csv(ticker_file_name, na_values=['NA'])
+            df_ticker = read_table(ticker_file_name)
+            # permatickers identify a company across ticker changes
+            sep_tickers = df_ticker[df_ticker.table == 'SEP']
+            permatickers = dict(zip(sep_tickers.ticker, sep_tickers.permaticker))
             # remove ADRs, Warrants, ETFs, micro-caps and companies de-listed post 2016
-            df_ticker = list(df_ticker[(df_ticker.category.isin(['Domestic', 'Domestic Primary'])) &
+            df_ticker = set(df_ticker[(df_ticker.category.isin(['Domestic', 'Domestic Primary'])) &
                     (pd.to_datetime(df_ticker.lastpricedate) >= pd.to_datetime('2005-01-01')) &
                     (df_ticker.scalemarketcap.isin(['5 - Large', '4 - Mid', '3 - Small', '6 - Mega']))].ticker)
 
-        print("starting ingesting data from: {}".format(file_name))
-
-        # read in the whole dump (will require ~7GB of RAM)
-        df = pd.read_csv(file_name, index_col='date', parse_dates=['date'], na_values=['NA'])
-
-        if ticker_file_name is not None:
-            df = df[df.ticker.isin(df_ticker)]
-
-        # drop unused columns, dividends will be used later
-        df = df.drop(['lastupdated', 'dividends', 'closeunadj'], axis=1)
-
-        # counter of valid securites, this will be our primary key
-        sec_counter = 0
-        data_list = []  # list to send to daily_bar_writer
-        metadata_list = []  # list to send to asset_db_writer (metadata)
-
-        # iterate over all the unique securities and pack data, and metadata
-        # for writing
-        for tkr, df_tkr in df.groupby('ticker'):
-            df_tkr = df_tkr.sort_index()
-
-            row0 = df_tkr.ix[0]  # get metadata from row
-
-            print(" preparing {}".format(row0["ticker"]))
-            check_for_abnormal_returns(df_tkr)
-
-            # check to see if there are missing dates in the middle
-            this_cal = us_calendar[(us_calendar >= df_tkr.index[0]) & (us_calendar <= df_tkr.index[-1])]
-            if len(this_cal) != df_tkr.shape[0]:
-                print('MISSING interstitial dates for: %s using forward fill' % row0["ticker"])
-                print('number of dates missing: {}'.format(len(this_cal) - df_tkr.shape[0]))
-                df_desired = pd.DataFrame(index=this_cal.tz_localize(None))
-                df_desired = df_desired.join(df_tkr)
-                df_tkr = df_desired.fillna(method='ffill')
-
-            # update metadata; 'start_date', 'end_date', 'auto_close_date',
-            # 'symbol', 'exchange', 'asset_name'
-            metadata_list.append((df_tkr.index[0],
-                                  df_tkr.index[-1],
-                                  df_tkr.index[-1] + pd.Timedelta(days=1),
-                                  row0["ticker"],
-                                  "SEP",  # all have exchange = SEP
-                                  row0["ticker"]
-                                  )
-                                 )
-
-            # drop metadata columns
-            df_tkr = df_tkr.drop(['ticker'], axis=1)
-
-            # pack data to be written by daily_bar_writer
-            data_list.append((sec_counter, df_tkr))
-            ticker2sid_map[tkr] = sec_counter  # record the sid for use later
-            sec_counter += 1
-
-        print("writing data for {} securities".format(len(metadata_list)))
-        daily_bar_writer.write(data_list, show_progress=False)
-
-        # write metadata
-        metadata_headers = ['start_date', 'end_date', 'auto_close_date',
-                            'symbol', 'exchange', 'asset_name']
-        asset_db_writer.write(equities=pd.DataFrame(metadata_list, columns=metadata_headers))
-        print("a total of {} securities were loaded into this bundle".format(
-            sec_counter))
-
-        # read in Dividend History
-        dfd = pd.read_csv(file_name, index_col='date', parse_dates=['date'], na_values=['NA'])
-        if ticker_file_name is not None:
-            dfd = dfd[dfd.ticker.isin(df_ticker)]
-
-        # drop rows where dividends == 0.0
-        dfd = dfd[dfd["dividends"] != 0.0]
-        dfd = dfd.dropna()
+        kept = df_ticker if ticker_file_name is not None else None
+        state_path = state_dir if state_dir is not None else environ.get('SEP_STATE_DIR')
+        delta_mode = delta if delta is not None else environ.get('SEP_DELTA', '0') == '1'
+        state = load_sep_state(state_path) if (delta_mode and state_path is not None) else None
+        since = state['lastupdated'] if state is not None else None
+        max_rows = max(1, int(max_memory_mb * 2 ** 20 / SEP_ROW_BYTES))
 
-        dfd.loc[:, 'ex_date'] = dfd.loc[:, 'record_date'] = dfd.index
-        dfd.loc[:, 'declared_date'] = dfd.loc[:, 'pay_date'] = dfd.index
-        dfd.loc[:, 'sid'] = dfd.loc[:, 'ticker'].apply(lambda x: ticker2sid_map[x])
-        dfd = dfd.rename(columns={'dividends': 'amount'})
-        dfd = dfd.drop(['open', 'high', 'low', 'close', 'volume', 'lastupdated', 'ticker', 'closeunadj'], axis=1)
-
-        # # format dfd to have sid
-        adjustment_writer.write(dividends=dfd)
+        print("starting ingesting data from: {}".format(file_name))
+        if since is not None:
+            print("only processing rows updated on or after {}".format(since))
+
+        with measure('sep.read', delta=since is not None) as m:
+            if is_table(file_name):
+                # partitioned by ticker, the bars are read one batch of tickers at a time
+                raw = None
+                in_dump, rows = table_tickers(file_name)
+                if since is not None:
+                    updates, update_dividends = read_sep_chunked(file_name, tickers=kept,
+                                                                 max_memory_mb=max_memory_mb, since=since)
+            else:
+                # csv dumps are not partitioned by ticker, they are read whole and then split into batches
+                raw, raw_dividends = read_sep_chunked(file_name, tickers=kept, max_memory_mb=max_memory_mb)
+                in_dump, rows = np.unique(raw['ticker'].values.astype(str), return_counts=True)
+                if since is not None:
+                    is_update = (raw['lastupdated'] >= since).values
+                    updates = raw[is_update]
+                    update_dividends = raw_dividends[raw_dividends['ticker'].isin(updates['ticker']).values]
+                    update_dividends = update_dividends[_row_keys(update_dividends.reset_index()).isin(
+                        _row_keys(updates.reset_index()))]
+            m['rows_out'] = updates.shape[0] if since is not None else int(rows.sum())
+
+        if kept is not None:
+            in_kept = np.array([t in kept for t in in_dump], dtype=bool)
+            in_dump, rows = in_dump[in_kept], rows[in_kept]
+        rows_of = dict(zip(in_dump, rows))
+
+        # saved batches keep their tickers, tickers that left the filter are dropped, tickers that are not in
+        # the saved batches yet are prepared from their full history
+        old_batches = []
+        if since is not None:
+            old_batches = [(i, [t for t in batch if kept is None or t in kept])
+                           for i, batch in enumerate(state['batches'])]
+            old_batches = [(i, batch) for i, batch in old_batches if batch]
+        known = set(t for _, batch in old_batches for t in batch)
+        new_tickers = [t for t in in_dump if t not in known]
+        if since is not None and new_tickers:
+            print("reading the full history of {} new tickers".format(len(new_tickers)))
+
+        # sids of previous ingests are kept, new tickers get new sids in sorted order
+        registry = SidRegistry.load(registry_file)
+        ticker2sid_map.update(registry.assign(sorted(known.union(new_tickers)),
+                                              permatickers if ticker_file_name is not None else None))
+        registry.save(registry_file)
+        if on_registry is not None:
+            on_registry(dict(ticker2sid_map))
+
+        new_tickers = sorted(new_tickers, key=lambda t: ticker2sid_map[t])
+        plan = [('saved', i, batch) for i, batch in old_batches]
+        plan += [('new', None, batch) for batch in plan_batches(new_tickers, [rows_of[t] for t in new_tickers],
+                                                                 max_rows)]
+
+        sessions = us_calendar if us_calendar.tz is None else us_calendar.tz_localize(None)
+        new_state = None if state_path is None else state_path.rstrip('/') + '.tmp'
+        if new_state is not None:
+            if os.path.exists(new_state):
+                shutil.rmtree(new_state)
+            os.makedirs(new_state)
+
+        metadata, dividends, saved, totals = [], [], [], {'gaps': 0, 'gap_tickers': 0, 'abnormal': 0,
+                                                          'abnormal_tickers': 0, 'rows': 0}
+        newest = [since]
+
+        def prepare_batch(source, i, batch):
+            if source == 'new':
+                if raw is None:
+                    df, dfd = read_sep_chunked(file_name, tickers=batch, max_memory_mb=max_memory_mb)
+                else:
+                    df = raw[raw['ticker'].isin(batch).values]
+                    dfd = raw_dividends[raw_dividends['ticker'].isin(batch).values]
+                newest.append(df['lastupdated'].max())
+                return prepare_panel(df.drop(['lastupdated'], axis=1), sessions, workers=workers) + (dfd,)
+
+            panel, report, dfd = load_sep_batch(state_path, i)
+            panel = panel[panel['ticker'].isin(batch).values]
+            report = report[report['ticker'].isin(batch).values]
+            dfd = dfd[dfd['ticker'].isin(batch).values]
+            df = updates[updates['ticker'].isin(batch).values]
+            if df.shape[0]:
+                newest.append(df['lastupdated'].max())
+                df = df.drop(['lastupdated'], axis=1)
+                panel, report = merge_delta(panel, report, df, sessions, workers=workers)
+                old_dfd = dfd.reset_index()
+                new_dfd = update_dividends[update_dividends['ticker'].isin(batch).values].reset_index()
+                dfd = pd.concat([old_dfd[~_row_keys(old_dfd).isin(_row_keys(df.reset_index()))], new_dfd],
+                                ignore_index=True)
+                dfd = dfd.sort_values(['ticker', 'date'], kind='mergesort').set_index('date')
+            return panel, report, dfd
+
+        def bars():
+            # one batch of tickers at a time: read, prepare, save and hand the bars to the writer in sid order
+            for j, (source, i, batch) in enumerate(plan):
+                with measure('sep.prepare', children=True, batch=j, source=source, workers=workers) as m:
+                    panel, report, dfd = prepare_batch(source, i, batch)
+                    m['rows_out'] = panel.shape[0]
+                if new_state is not None:
+                    save_sep_batch(new_state, len(saved), panel, report, dfd)
+                    saved.append(batch)
+                dividends.append(dfd)
+
+                gaps = report[report.issue == 'missing_session']
+                abnormal = report[report.issue == 'abnormal_return']
+                totals['gaps'] += gaps.shape[0]
+                totals['gap_tickers'] += gaps.ticker.nunique()
+                totals['abnormal'] += abnormal.shape[0]
+                totals['abnormal_tickers'] += abnormal.ticker.nunique()
+                totals['rows'] += panel.shape[0]
+                if report_file is not None:
+                    report.to_csv(report_file, index=False, mode='a' if j else 'w', header=not j)
+
+                tickers, starts, ends = segment_bounds(panel['ticker'].values)
+                sids = np.array([ticker2sid_map[tkr] for tkr in tickers], dtype=np.int64)
+                order = np.argsort(sids, kind='mergesort')
+                tickers, starts, ends, sids = tickers[order], starts[order], ends[order], sids[order]
+
+                # metadata; 'start_date', 'end_date', 'auto_close_date',
+                # 'symbol', 'exchange', 'asset_name'
+                dates = panel['date'].values
+                end_dates = pd.DatetimeIndex(dates[ends - 1])
+                metadata.append(pd.DataFrame({'start_date': pd.DatetimeIndex(dates[starts]),
+                                              'end_date': end_dates,
+                                              'auto_close_date': end_dates + pd.Timedelta(days=1),
+                                              'symbol': tickers,
+                                              'exchange': 'SEP',  # all have exchange = SEP
+                                              'asset_name': tickers},
+                                             index=sids,
+                                             columns=['start_date', 'end_date', 'auto_close_date',
+                                                      'symbol', 'exchange', 'asset_name']))
+
+                frame = panel.drop(['ticker'], axis=1).set_index('date')
+                del panel, report
+                for sid, start, end in zip(sids, starts, ends):
+                    yield sid, frame.iloc[start:end]
+
+        print("writing data for {} securities in {} batches".format(len(ticker2sid_map), len(plan)))
+        with measure('sep.write_bars', batches=len(plan)) as m:
+            daily_bar_writer.write(bars(), show_progress=False)
+            m['rows_in'] = totals['rows']
+
+            # write metadata
+            metadata = pd.concat(metadata) if metadata else pd.DataFrame(
+                columns=['start_date', 'end_date', 'auto_close_date', 'symbol', 'exchange', 'asset_name'])
+            asset_db_writer.write(equities=metadata)
+        print("forward filled {} missing sessions for {} securities".format(totals['gaps'], totals['gap_tickers']))
+        print("found {} abnormal returns for {} securities".format(totals['abnormal'], totals['abnormal_tickers']))
+        print("a total of {} securities were loaded into this bundle".format(metadata.shape[0]))
+
+        # Dividend History, collected batch by batch
+        dfd = pd.concat(dividends) if dividends else pd.DataFrame({'ticker': [], 'dividends': []},
+                                                                  index=pd.DatetimeIndex([], name='date'))
+        with measure('sep.write_dividends') as m:
+            m['rows_in'] = dfd.shape[0]
+            adjustment_writer.write(dividends=format_dividends(dfd, ticker2sid_map))
+
+        if new_state is not None:
+            with measure('sep.save_state') as m:
+                m['rows_in'] = totals['rows']
+                newest = [t for t in newest if t is not None and not pd.isnull(t)]
+                save_sep_state(new_state, max(newest) if newest else since, saved)
+                _replace_dir(new_state, state_path)
 
     return ingest
 
 
-def ingest_sep(newest_files):
+def ingest_sep(newest_files, delta=False, on_registry=None, workers=1):
     """
-    Ingests Sharadar SEP bulk file into Zipline
+    Ingests Sharadar SEP bulk file into Zipline, in this process
     :param newest_files: Dictionary that includes 'SEP' and 'TICKERS' as keys, and file directories as values
+    :param delta: If True, only process rows of the SEP file that are new or revised since the last ingest
+    :param on_registry: Function called with the ticker to sid dictionary once the sids are registered, before
+    the bars are written
+    :param workers: Number of processes used to prepare the bars of each ticker, see prepare_panel
     :return:
     """
-    os.environ['SEP_DIR'] = newest_files['SEP']
-    os.environ['TICKERS_DIR'] = newest_files['TICKERS']
+    register('sep',
+             from_sep_dump(newest_files['SEP'], newest_files['TICKERS'],
+                           workers=workers,
+                           state_dir=os.environ['QUANDL_BASE'] + 'sep_state/',
+                           delta=delta,
+                           on_registry=on_registry),
+             calendar_name='NYSE')
 
     print("Start ingestion")
-    subprocess.call(os.getcwd() + "/ingest.sh", shell=True)
+    ingest('sep', os.environ, show_progress=False)
     print("End ingestion")
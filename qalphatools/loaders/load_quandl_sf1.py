@@ -1,83 +1,185 @@
 # Code adapted from https://github.com/pbharrin/alpha-compiler/tree/master/alphacompiler
 
-from qalphatools.utils.bundle import get_ticker_sid_dict_from_bundle
-from qalphatools.loaders.load_quandl_sep import from_sep_dump
+from qalphatools.utils.registry import get_ticker_sid_dict
+from qalphatools.utils.store import write_sparse_store, write_dense_panel
+from qalphatools.utils.table import read_table
+from qalphatools.utils.instrument import measure
 
 from os import listdir
 import numpy as np
 import pandas as pd
 import os
 
-from zipline.data.bundles.core import register
+from zipline.utils.calendars import get_calendar
 from zipline.utils.paths import zipline_root
 
 
-def pack_sparse_data(N, rawpath, fields, filename):
-    """pack data into np.recarray and persists it to a file to be
-    used by SparseDataFactor"""
+def pack_sparse_frame(df, N, fields, filename):
+    """pack data into ragged arrays and persists them to a store directory to be
+    used by SparseDataFactor. The rows of all sids are concatenated, sid s
+    owns rows offsets[s]:offsets[s + 1] of dates and of each field
+
+    :param df: DataFrame with columns sid, Date and one column per field, sorted by sid and Date
+    :param N: number of sids in the packed data, max(sid) + 1 or more
+    :param fields: fields to pack
+    :param filename: store directory to write the packed data to
+    """
+    with measure('pack', store=filename, fields=len(fields)) as m:
+        m['rows_in'] = df.shape[0]
+        sids = df['sid'].values.astype(np.int64)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(sids, minlength=N))])
+
+        write_sparse_store(filename,
+                           pd.to_datetime(df['Date']).values.astype('datetime64[ns]').astype(np.int64),
+                           offsets,
+                           {field: df[field].values.astype(np.float64) for field in fields})
 
 
-    # create buffer to hold data for all tickers
-    dfs = [None] * N
+def pack_sparse_data(N, rawpath, fields, filename):
+    """pack per-sid csv files, as exported by load_sf1, into ragged arrays and persists them
+    to a file to be used by SparseDataFactor"""
 
-    max_len = -1
+    dfs = []
     print("Packing sids")
-    for fn in listdir(rawpath):
-        if not fn.endswith(".csv"):
-            continue
-        df = pd.read_csv(os.path.join(rawpath,fn), index_col="Date", parse_dates=True)
-        df = df.sort_index()
-        sid = int(fn.split('.')[0])
-        #print("packing sid: %d" % sid)
-        dfs[sid] = df
-
-        # width is max number of rows in any file
-        max_len = max(max_len, df.shape[0])
+    with measure('pack_sparse_data.read', path=rawpath) as m:
+        for fn in listdir(rawpath):
+            if not fn.endswith(".csv"):
+                continue
+            df = pd.read_csv(os.path.join(rawpath, fn), index_col="Date", parse_dates=True)
+            df = df.sort_index()
+            df['sid'] = int(fn.split('.')[0])
+            dfs.append(df.reset_index())
+        m['files'] = len(dfs)
+        m['rows_out'] = sum(df.shape[0] for df in dfs)
     print("Finished packing sids")
 
-    # temp workaround for `Array Index Out of Bound` bug
-    max_len = max_len + 1
+    df = pd.concat(dfs, ignore_index=True).sort_values('sid', kind='mergesort')
+    pack_sparse_frame(df, N, fields, filename)
 
-    # pack up data as buffer
-    num_fundamentals = len(fields)
-    buff = np.full((num_fundamentals + 1, N, max_len), np.nan)
 
-    dtypes = [('date', '<f8')]
-    for field in fields:
-        dtypes.append((field, '<f8'))
+def select_dimensions(data, fields, dimensions=None, lastupdated=False):
+    """
+    Select the dimension used for each field of every ticker in one vectorized pass over the SF1 table
+    :param data: DataFrame with the SF1 table
+    :param fields: fields to select
+    :param dimensions: dimensions to select. One-to-one with fields. If None, use ARQ for the tickers that
+    have any ARQ data for a field, ART if not
+    :param lastupdated: If True, add a lastupdated column with the latest lastupdated value of the rows
+    selected for each (ticker, Date)
+    :return: DataFrame indexed by (ticker, Date) with one column per field, sorted by ticker and Date
+    """
+    data = data.rename(columns={'datekey': 'Date'})
+    # number repeated datekeys, so rows of different fields only align with their counterpart
+    data = data.assign(n=data.groupby(['ticker', 'dimension', 'Date']).cumcount())
 
-    # pack self.data as np.recarray
-    data = np.recarray(shape=(N, max_len), buf=buff, dtype=dtypes)
+    if dimensions is None:
+        arq = data[data.dimension == 'ARQ']
+        art = data[data.dimension == 'ART']
+        has_arq = arq.groupby('ticker')[fields].count() > 0
 
-    # iterate over loaded data and populate self.data
-    for i, df in enumerate(dfs):
-        if df is None:
-            continue
-        ind_len = df.index.shape[0]
-        data.date[i, :ind_len] = df.index
-        for field in fields:
-            data[field][i, :ind_len] = df[field]
+    series, updates = [], []
+    for i, field in enumerate(fields):
+        if dimensions is None:
+            arq_tickers = has_arq.index[has_arq[field].values]
+            df = pd.concat([arq[arq.ticker.isin(arq_tickers)], art[~art.ticker.isin(arq_tickers)]])
+        else:
+            df = data[data.dimension == dimensions[i]]
+        df = df.set_index(['ticker', 'Date', 'n'])
+        series.append(df[field])
+        if lastupdated:
+            updates.append(pd.to_datetime(df['lastupdated']).rename('lastupdated_{}'.format(i)))
 
-    data.dump(filename)  # can be read back with np.load()
+    df = pd.concat(series + updates, axis=1).sort_index()
+    if lastupdated:
+        update_columns = [u.name for u in updates]
+        df['lastupdated'] = df[update_columns].max(axis=1)
+        df = df.drop(update_columns, axis=1)
+    return df.reset_index(level='n', drop=True)
 
 
-def load_sf1(sf1_dir, fields, dimensions=None):
+def update_revision_history(current, history, fields):
     """
-    Loads SF1 data into a npy compressed file SF1.npy
-    :param sf1_dir: Sharadar SF1 bulk file
-    :param fields: fields to load
-    :param dimensions: dimensions to load. One-to-one with fields. If None, assume ARQ if data available,
-    ART if not
+    Record the SF1 values that changed since the last run. The first run records every row as known
+    from its datekey. Later runs record new rows, and rows whose values changed, as known from
+    max(datekey, lastupdated)
+
+    :param current: DataFrame indexed by (ticker, Date) with the fields and a lastupdated column,
+    as returned by select_dimensions
+    :param history: DataFrame with the history of previous runs, as returned by this function, or None. Fields
+    added since the previous run are filled in on its rows with their current values
+    :param fields: fields in current
+    :return: DataFrame with columns ticker, Date, n, available and one column per field, with one row
+    per revision, sorted by available
     """
-    stocks_dir = os.environ['QUANDL_BASE'] + 'stocks'
+    current = current.reset_index()
+    current['n'] = current.groupby(['ticker', 'Date']).cumcount()
+    datekeys = pd.to_datetime(current['Date'])
+    columns = ['ticker', 'Date', 'n', 'available'] + list(fields)
 
-    register('sep', from_sep_dump('.', '.'), )
-    num_tickers = len(get_ticker_sid_dict_from_bundle('sep'))
-    print('number of tickers: ', num_tickers)
+    if history is None:
+        current['available'] = datekeys
+        return current[columns].sort_values('available', kind='mergesort').reset_index(drop=True)
+
+    # fields added since the last run are filled in on the recorded rows, as the first run records them,
+    # so their values are known from the datekey of each row instead of being recorded as revisions
+    added = [field for field in fields if field not in history.columns]
+    if added:
+        print("filling in {} on the recorded SF1 rows".format(', '.join(added)))
+        history = history.merge(current[['ticker', 'Date', 'n'] + added], on=['ticker', 'Date', 'n'], how='left')
+
+    # latest known revision of each row, history is sorted by available
+    known = history.drop_duplicates(['ticker', 'Date', 'n'], keep='last')
+    merged = current.merge(known, on=['ticker', 'Date', 'n'], how='left', suffixes=('', '_known'))
 
-    data = pd.read_csv(sf1_dir)
+    changed = merged['available'].isnull().values
+    for field in fields:
+        new, old = merged[field].values, merged[field + '_known'].values
+        changed = changed | ~((new == old) | (pd.isnull(new) & pd.isnull(old)))
+
+    revisions = current[changed].copy()
+    revisions['available'] = np.where(revisions['lastupdated'].values > datekeys[changed].values,
+                                      revisions['lastupdated'].values, datekeys[changed].values)
+    print("recorded {} new or revised SF1 rows".format(revisions.shape[0]))
+
+    history = pd.concat([history, revisions[columns]], ignore_index=True)
+    return history.sort_values('available', kind='mergesort').reset_index(drop=True)
+
+
+def point_in_time_timeline(history, fields):
+    """
+    Build the values known as of each revision from a revision history. At any time, the known value of a
+    ticker is the latest revision of its latest datekey, so revisions of older datekeys are dropped
+
+    :param history: DataFrame as returned by update_revision_history
+    :param fields: fields in history
+    :return: DataFrame with columns ticker, Date and one column per field, where Date is the time from which
+    the values are known, sorted by ticker and Date
+    """
+    history = history.sort_values(['ticker', 'available', 'Date', 'n'], kind='mergesort')
 
-    tickers = get_ticker_sid_dict_from_bundle('sep')
+    # order of the rows of a ticker by datekey, and number within repeated datekeys
+    datekeys = pd.to_datetime(history['Date']).values.astype('datetime64[ns]').astype(np.int64)
+    ranks = np.unique(datekeys, return_inverse=True)[1].ravel()
+    history['key'] = ranks * (history['n'].max() + 1) + history['n'].values
+
+    latest = history.groupby('ticker')['key'].cummax()
+    timeline = history[history['key'].values == latest.values]
+    timeline = timeline.drop_duplicates(['ticker', 'available'], keep='last')
+
+    timeline = timeline[['ticker', 'available'] + list(fields)].rename(columns={'available': 'Date'})
+    return timeline.reset_index(drop=True)
+
+
+def export_sparse_csv(data, tickers, fields, export_dir):
+    """
+    Write one csv file per sid with the SF1 data selected by select_dimensions
+    :param data: DataFrame indexed by (ticker, Date), as returned by select_dimensions
+    :param tickers: Dictionary with tickers as keys and sids as values
+    :param fields: fields in data
+    :param export_dir: directory to write the files to
+    """
+    present = set(data.index.get_level_values('ticker'))
+    empty = pd.DataFrame(columns=fields, index=pd.Index([], name='Date'))
 
     counter = 0
     for ticker, sid in tickers.items():
@@ -85,28 +187,132 @@ def load_sf1(sf1_dir, fields, dimensions=None):
         if counter % 100 == 0:
             print("Working on {}-th file".format(counter))
 
-        df = data[(data.ticker == ticker)]
-        df = df.rename(columns={'datekey': 'Date'}).set_index('Date')
-        df.index = df.index.rename('Date')
-        series = []
-        for i, field in enumerate(fields):
-            if dimensions is None:
-                if df[df.dimension == 'ARQ'][field].isna().sum() == df[df.dimension == 'ARQ'].shape[0]:
-                    s = df[df.dimension == 'ART'][field]
-                else:
-                    s = df[df.dimension == 'ARQ'][field]
-            else:
-                s = df[df.dimension == dimensions[i]][field]
-            series.append(s)
-
-        df = pd.concat(series, axis=1)
-        df = df.sort_index()
-        df.index = df.index.rename('Date')
-        df.to_csv(os.path.join(stocks_dir, "{}.csv".format(sid)))
-
-    pack_sparse_data(num_tickers + 1,  # number of tickers in bundle + 1
-                     stocks_dir,
-                     fields,
-                     zipline_root() + '/data/' + 'SF1.npy')  # write directly to the zipline data dir
+        df = data.xs(ticker, level='ticker') if ticker in present else empty
+        df.to_csv(os.path.join(export_dir, "{}.csv".format(sid)))
+
+
+def pack_selected(data, tickers, fields, filename):
+    """
+    Pack SF1 data selected by select_dimensions into a store
+    :param data: DataFrame indexed by (ticker, Date), as returned by select_dimensions
+    :param tickers: Dictionary with tickers as keys and sids as values
+    :param fields: fields in data
+    :param filename: store directory
+    """
+    data = data.reset_index()
+    data.insert(0, 'sid', data['ticker'].map(tickers).values)
+    data = data.sort_values('sid', kind='mergesort')
+
+    pack_sparse_frame(data,
+                      max(tickers.values()) + 2,  # max(sid) + 1, plus one spare row
+                      fields,
+                      filename)
+
+
+def pack_point_in_time(data, tickers, fields, history_file, filename):
+    """
+    Update the SF1 revision history and pack the values known at each point in time into a store
+    :param data: DataFrame as returned by select_dimensions with lastupdated=True
+    :param tickers: Dictionary with tickers as keys and sids as values
+    :param fields: fields in data
+    :param history_file: Revision history file. If None, use SF1_history.pkl in $QUANDL_BASE
+    :param filename: store directory
+    """
+    if history_file is None:
+        history_file = os.environ['QUANDL_BASE'] + 'SF1_history.pkl'
+
+    history = pd.read_pickle(history_file) if os.path.exists(history_file) else None
+    history = update_revision_history(data, history, fields)
+    history.to_pickle(history_file)
+
+    timeline = point_in_time_timeline(history[history.ticker.isin(tickers)], fields)
+    print("point in time data has {} rows for {} latest rows ({:.1%} overhead)".format(
+        timeline.shape[0], data.shape[0], timeline.shape[0] / float(max(data.shape[0], 1)) - 1))
+
+    timeline.insert(0, 'sid', timeline['ticker'].map(tickers).values)
+    timeline = timeline.sort_values('sid', kind='mergesort')
+
+    pack_sparse_frame(timeline,
+                      max(tickers.values()) + 2,  # max(sid) + 1, plus one spare row
+                      fields,
+                      filename)
+
+
+def load_sf1(sf1_dir, fields, dimensions=None, export_dir=None, point_in_time=False, history_file=None,
+             store_dimensions=None):
+    """
+    Loads SF1 data into the packed store SF1. The fields selected with dimensions are packed into
+    SF1/default, and every field is packed again for each of store_dimensions into SF1/<dimension>
+    :param sf1_dir: Sharadar SF1 table directory converted by convert_csv, or SF1 bulk file
+    :param fields: fields to load
+    :param dimensions: dimensions to load. One-to-one with fields. If None, assume ARQ if data available,
+    ART if not
+    :param export_dir: If provided, also write one csv file per sid to this directory, for debugging.
+    These files can be packed with pack_sparse_data
+    :param point_in_time: If True, keep every revision of the SF1 values in a history file and pack the values
+    as known at each point in time into SF1_pit/default, instead of the latest values into SF1/default
+    :param history_file: Revision history file used when point_in_time is True. If None, use SF1_history.pkl
+    in $QUANDL_BASE
+    :param store_dimensions: dimensions to pack all fields for, e.g. ['ARQ', 'ART', 'MRQ', 'MRT', 'ARY'].
+    Stores of dimensions that are not listed are left as they are
+    """
+    tickers = get_ticker_sid_dict('sep')
+    num_tickers = len(tickers)
+    print('number of tickers: ', num_tickers)
+
+    with measure('sf1.read') as m:
+        # only the columns used below are read, lastupdated dates the revisions of point in time stores
+        columns = ['ticker', 'dimension', 'datekey'] + (['lastupdated'] if point_in_time else []) + list(fields)
+        data = read_table(sf1_dir, columns=columns, tickers=tickers)
+        m['rows_out'] = data.shape[0]
+    store_dir = zipline_root() + '/data/' + 'SF1'
+
+    for dimension in store_dimensions or []:
+        print("Packing {}".format(dimension))
+        with measure('sf1.select', dimension=dimension) as m:
+            m['rows_in'] = data.shape[0]
+            selected = select_dimensions(data, fields, [dimension] * len(fields))
+            m['rows_out'] = selected.shape[0]
+        pack_selected(selected, tickers, fields, os.path.join(store_dir, dimension))
+
+    # pick the dimension of every field for all tickers at once
+    with measure('sf1.select', dimension='default') as m:
+        m['rows_in'] = data.shape[0]
+        data = select_dimensions(data, fields, dimensions, lastupdated=point_in_time)
+        m['rows_out'] = data.shape[0]
+
+    if point_in_time:
+        pack_point_in_time(data, tickers, fields, history_file, zipline_root() + '/data/' + 'SF1_pit/default')
+        return
+
+    if export_dir is not None:
+        export_sparse_csv(data, tickers, fields, export_dir)
+
+    # write directly to the zipline data dir
+    pack_selected(data, tickers, fields, os.path.join(store_dir, 'default'))
+
+
+def build_dense_panels(start, end=None, stores=('default',)):
+    """
+    Build the dense daily panels read by DenseFundamentals from the SF1 stores written by load_sf1.
+    Each panel holds the forward filled values of every sid on each session between start and end
+    :param start: first session of the panels
+    :param end: last session of the panels. If None, today
+    :param stores: SF1 stores to build panels for, 'default' and dimensions packed with store_dimensions
+    """
+    sessions = get_calendar("NYSE").all_sessions
+    sessions = sessions if sessions.tz is None else sessions.tz_localize(None)
+    end = pd.Timestamp.today().normalize() if end is None else pd.Timestamp(end)
+    sessions = sessions[(sessions >= pd.Timestamp(start)) & (sessions <= end)]
+    sessions = sessions.values.astype('datetime64[ns]').astype(np.int64)
 
+    store_dir = zipline_root() + '/data/' + 'SF1'
+    dense_dir = zipline_root() + '/data/' + 'SF1_dense'
+    if not os.path.exists(dense_dir):
+        os.makedirs(dense_dir)
 
+    for store in stores:
+        print("Building dense panel {} for {} sessions".format(store, sessions.shape[0]))
+        with measure('dense_panel', store=store) as m:
+            m['rows_out'] = sessions.shape[0]
+            write_dense_panel(os.path.join(store_dir, store), os.path.join(dense_dir, store), sessions)
@@ -1,11 +1,14 @@
 # Code adapted from https://github.com/pbharrin/alpha-compiler/tree/master/alphacompiler
 
-from qalphatools.utils.bundle import get_ticker_sid_dict_from_bundle
+from qalphatools.utils.registry import get_ticker_sid_dict
+from qalphatools.utils.store import write_columns, write_sparse_store
+from qalphatools.utils.table import read_table, table_columns
+from qalphatools.utils.instrument import measure
 
 import pandas as pd
 import numpy as np
+import os
 
-from zipline.data.bundles.core import register
 from zipline.utils.paths import zipline_root
 
 
@@ -45,42 +48,146 @@ CATEGORY_CODING = {'Domestic': 0,
                    'ADR Secondary': 13, }
 
 
-def load_static(filepath):
-    """Stores static items to a persisted np array.
+# dtype of each static field, sic codes have four digits and GICS codes up to eight
+STATIC_DTYPES = {'sector': np.int16,
+                 'exchange': np.int16,
+                 'category': np.int16,
+                 'industry': np.int32}
+
+
+# date from which the classification of a ticker first seen by load_static is assumed to hold
+HISTORY_START = pd.Timestamp('1900-01-01')
+
+
+def read_static(filepath):
+    """
+    Read the SEP tickers of the Sharadar TICKERS table and code their static fields
+    :param filepath: Sharadar TICKERS table directory converted by convert_csv, or TICKERS bulk file
+    :return: DataFrame indexed by ticker with one column per static field and a lastupdated column
+    """
+    # only the columns coded below are read, lastupdated is missing from older TICKERS files
+    columns = ['ticker', 'table', 'exchange', 'sector', 'category', 'siccode']
+    columns += [c for c in ['lastupdated'] if c in table_columns(filepath)]
+    df = read_table(filepath, columns=columns).set_index("ticker")
+    df = df[df.exchange != 'None']
+    df = df[df.exchange != 'INDEX']
+    df = df[df.table == 'SEP']
+    df = df[~df.index.duplicated(keep='last')]
+
+    coded = pd.DataFrame({'sector': df['sector'].map(SECTOR_CODING),
+                          'exchange': df['exchange'].map(EXCHANGE_CODING),
+                          'category': df['category'].map(CATEGORY_CODING),
+                          'industry': df['siccode']}, index=df.index).fillna(-1)
+    for field, dtype in STATIC_DTYPES.items():
+        coded[field] = coded[field].values.astype(dtype)
+
+    if 'lastupdated' in df.columns:
+        coded['lastupdated'] = pd.to_datetime(df['lastupdated'])
+    else:
+        coded['lastupdated'] = pd.NaT
+    return coded
+
+
+def update_static_history(coded, history, as_of=None):
+    """
+    Record the classification changes since the last run. The first run records the classification of every
+    ticker as in effect since HISTORY_START. Later runs record new tickers the same way, and tickers whose
+    codes changed as in effect from their lastupdated date, or from as_of if it is missing
+
+    :param coded: DataFrame as returned by read_static
+    :param history: DataFrame with the history of previous runs, as returned by this function, or None
+    :param as_of: date of the TICKERS table. If None, today
+    :return: DataFrame with columns ticker, date and one column per static field, with one row per
+    classification change, sorted by ticker and date
+    """
+    as_of = pd.Timestamp.today().normalize() if as_of is None else pd.Timestamp(as_of)
+    fields = list(STATIC_DTYPES)
+    current = coded.reset_index()
+
+    if history is None:
+        current['date'] = HISTORY_START
+        changed = current
+    else:
+        # latest recorded codes of each ticker, history is sorted by ticker and date
+        known = history.drop_duplicates('ticker', keep='last')
+        merged = current.merge(known, on='ticker', how='left', suffixes=('', '_known'))
+
+        new_tickers = merged['date'].isnull().values
+        revised = ~new_tickers & np.any([merged[f].values != merged[f + '_known'].values for f in fields], axis=0)
+
+        dates = merged['lastupdated'].fillna(as_of).values
+        # a change is never recorded before the event it replaces
+        dates = np.where(dates > merged['date'].values, dates, as_of)
+        current['date'] = np.where(new_tickers, HISTORY_START, dates)
+        changed = current[new_tickers | revised]
+        print("recorded {} new tickers and {} classification changes".format(new_tickers.sum(), revised.sum()))
+
+    history = pd.concat([history, changed[['ticker', 'date'] + fields]], ignore_index=True)
+    history['date'] = pd.to_datetime(history['date'])
+    return history.sort_values(['ticker', 'date'], kind='mergesort').reset_index(drop=True)
+
+
+def pack_static_history(history, tickers, filename):
+    """
+    Pack a classification history into a store read by the Classification factor
+    :param history: DataFrame as returned by update_static_history
+    :param tickers: Dictionary with tickers as keys and sids as values
+    :param filename: store directory
+    """
+    history = history[history.ticker.isin(tickers)]
+    history.insert(0, 'sid', history['ticker'].map(tickers).values.astype(np.int64))
+    history = history.sort_values(['sid', 'date'], kind='mergesort')
+
+    N = max(tickers.values()) + 1
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(history['sid'].values, minlength=N))])
+    write_sparse_store(filename,
+                       history['date'].values.astype('datetime64[ns]').astype(np.int64),
+                       offsets,
+                       {field: history[field].values.astype(dtype) for field, dtype in STATIC_DTYPES.items()})
+
+
+def load_static(filepath, history_file=None):
+    """Stores static items to persisted np arrays, one per field, read by StaticData.
+    Changes of the static items over time are recorded in a history file and packed into
+    a store read by Classification.
     The following static fields are currently persisted.
     -Sector
     -exchange
     -category
     -industry: GICS
-    """
-    register('sep', int, )
-
-    df = pd.read_csv(filepath, index_col="ticker")
-    df = df[df.exchange != 'None']
-    df = df[df.exchange != 'INDEX']
-    df = df[df.table == 'SEP']
 
-    coded_sectors_for_ticker = df['sector'].map(SECTOR_CODING)
-    coded_exchange_for_ticker = df['exchange'].map(EXCHANGE_CODING)
-    coded_category_for_ticker = df['category'].map(CATEGORY_CODING)
-    coded_industry_for_ticker = df['siccode'].fillna(-1).astype('int')
+    :param filepath: Sharadar TICKERS table directory converted by convert_csv, or TICKERS bulk file
+    :param history_file: Classification history file. If None, use TICKERS_history.pkl in $QUANDL_BASE
+    """
+    with measure('static.read') as m:
+        coded = read_static(filepath)
+        m['rows_out'] = coded.shape[0]
 
-    ae_d = get_ticker_sid_dict_from_bundle('sep')
+    ae_d = get_ticker_sid_dict('sep')
     N = max(ae_d.values()) + 1
 
-    # create 2-D array to hold data where index = SID
-    static_data = np.full((4, N), -1, np.dtype('int64'))
-
-    # iterate over Assets in the bundle, and fill in static fields
+    # join the coded fields with the sids of the bundle, where index = SID
     print('Creating static data')
-    for ticker, sid in ae_d.items():
-        #print(ticker, sid, coded_sectors_for_ticker.get(ticker, -1))
-        static_data[0, sid] = coded_sectors_for_ticker.get(ticker, -1)
-        static_data[1, sid] = coded_exchange_for_ticker.get(ticker, -1)
-        static_data[2, sid] = coded_category_for_ticker.get(ticker, -1)
-        static_data[3, sid] = coded_industry_for_ticker.get(ticker, -1)
+    with measure('static.write') as m:
+        m['rows_in'] = coded.shape[0]
+        sids = pd.Series(ae_d)
+        joined = coded.reindex(sids.index)
+        static_data = {}
+        for field, dtype in STATIC_DTYPES.items():
+            static_data[field] = np.full(N, -1, dtype)
+            static_data[field][sids.values] = joined[field].fillna(-1).values.astype(dtype)
+
+        # finally save the files to disk
+        write_columns(zipline_root() + '/data/' + "SHARDAR_static", static_data)
+        m['rows_out'] = N
     print('Finished creating static data')
 
-    # finally save the file to disk
-    np.save(zipline_root() + '/data/' + "SHARDAR_static.npy", static_data)
-
+    if history_file is None:
+        history_file = os.environ['QUANDL_BASE'] + 'TICKERS_history.pkl'
+    history = pd.read_pickle(history_file) if os.path.exists(history_file) else None
+    with measure('static.history') as m:
+        m['rows_in'] = coded.shape[0]
+        history = update_static_history(coded, history)
+        history.to_pickle(history_file)
+        pack_static_history(history, ae_d, zipline_root() + '/data/' + "SHARDAR_static_history")
+        m['rows_out'] = history.shape[0]
@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+import threading
+
+
+MANIFEST_VERSION = 1
+# stages running in threads record their inputs in the same manifest
+_lock = threading.Lock()
+
+
+def manifest_path():
+    """Path of the manifest of downloaded tables and loader stages, stored in $QUANDL_BASE"""
+    return os.environ['QUANDL_BASE'] + 'manifest.json'
+
+
+def load_manifest(path=None):
+    """
+    Load the manifest that records the last_refreshed_time and content hash of each downloaded table, and
+    the inputs each loader stage last ran with
+    :param path: Manifest file. If None, use manifest.json in $QUANDL_BASE
+    :return: Dictionary with keys tables and stages, empty if the file does not exist
+    """
+    path = manifest_path() if path is None else path
+    if not os.path.exists(path):
+        return {'version': MANIFEST_VERSION, 'tables': {}, 'stages': {}}
+
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise ValueError('Unsupported manifest version {} in {}'.format(manifest.get('version'), path))
+    return manifest
+
+
+def save_manifest(manifest, path=None):
+    """
+    Save the manifest to disk
+    :param manifest: Manifest, as returned by load_manifest
+    :param path: Manifest file. If None, use manifest.json in $QUANDL_BASE
+    """
+    path = manifest_path() if path is None else path
+    tmp_path = path + '.tmp'
+    with _lock:
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+
+
+def fingerprint(obj):
+    """sha256 hash of a json serializable object, e.g. a ticker to sid dictionary"""
+    return hashlib.sha256(json.dumps(obj, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def stage_inputs(manifest, tables, **others):
+    """
+    Fingerprints of the inputs of a loader stage
+    :param manifest: Manifest, as returned by load_manifest
+    :param tables: tables read by the stage, their content hashes are taken from the manifest
+    :param others: other inputs of the stage, as fingerprints
+    :return: Dictionary with input names as keys and fingerprints as values
+    """
+    inputs = {table: manifest['tables'].get(table, {}).get('hash') for table in tables}
+    inputs.update(others)
+    return inputs
+
+
+def stage_changed(manifest, stage, inputs, outputs=()):
+    """
+    :param manifest: Manifest, as returned by load_manifest
+    :param stage: name of the stage
+    :param inputs: fingerprints of the inputs, as returned by stage_inputs
+    :param outputs: paths written by the stage. None stands for an output that is known to be missing
+    :return: True if the stage never ran, some input is unknown, some input changed since its last run or
+    some output is missing
+    """
+    if any(value is None for value in inputs.values()):
+        return True
+    missing = [path for path in outputs if path is None or not os.path.exists(path)]
+    if missing:
+        print('{} outputs missing: {}'.format(stage, ', '.join(path or 'never written' for path in missing)))
+        return True
+    return manifest['stages'].get(stage) != inputs
+
+
+def record_stage(manifest, stage, inputs, path=None):
+    """
+    Record the inputs a stage ran with, once it completed, and save the manifest
+    :param manifest: Manifest, as returned by load_manifest
+    :param stage: name of the stage
+    :param inputs: fingerprints of the inputs, as returned by stage_inputs
+    :param path: Manifest file. If None, use manifest.json in $QUANDL_BASE
+    """
+    with _lock:
+        manifest['stages'][stage] = dict(inputs)
+    save_manifest(manifest, path)
@@ -1,19 +1,66 @@
 # Code adapted from https://github.com/pbharrin/alpha-compiler/tree/master/alphacompiler
 
-from zipline.data.bundles.core import load
+from zipline.data.bundles.core import load, ingestions_for_bundle, most_recent_data
 import os
 
 
-def get_tickers_from_bundle(bundle_name):
-    """Gets a list of tickers from a given bundle"""
-    bundle_data = load(bundle_name, os.environ, None)
+# bundle data and derived asset lists, keyed by (bundle name, ingest timestamp)
+_bundle_cache = {}
+
+
+def _latest_ingestion(bundle_name):
+    """Timestamp of the most recent ingest of a bundle, None if it was never ingested"""
+    ingestions = ingestions_for_bundle(bundle_name, environ=os.environ)
+    return ingestions[0] if len(ingestions) else None
+
+
+def latest_ingestion_path(bundle_name):
+    """Directory of the most recent ingest of a bundle, None if it was never ingested"""
+    timestamp = _latest_ingestion(bundle_name)
+    return most_recent_data(bundle_name, timestamp, environ=os.environ) if timestamp is not None else None
+
+
+def _get_cache_entry(bundle_name):
+    """Gets the cache entry for the latest ingest of a bundle, loading the bundle if a new ingest landed"""
+    timestamp = _latest_ingestion(bundle_name)
+    key = (bundle_name, timestamp)
+
+    if key not in _bundle_cache:
+        # drop entries of older ingests of the same bundle
+        for stale in [k for k in _bundle_cache if k[0] == bundle_name]:
+            del _bundle_cache[stale]
+        _bundle_cache[key] = {'bundle_data': load(bundle_name, os.environ, timestamp)}
+
+    return _bundle_cache[key]
+
+
+def clear_bundle_cache():
+    """Drops all cached bundle data"""
+    _bundle_cache.clear()
 
-    # get a list of all sids
-    lifetimes = bundle_data.asset_finder._compute_asset_lifetimes()
-    all_sids = lifetimes.sid
 
-    # retreive all assets in the bundle
-    all_assets = bundle_data.asset_finder.retrieve_all(all_sids)
+def load_bundle(bundle_name):
+    """Loads a bundle once per process and ingest"""
+    return _get_cache_entry(bundle_name)['bundle_data']
+
+
+def _get_cached_assets(bundle_name):
+    entry = _get_cache_entry(bundle_name)
+    if 'assets' not in entry:
+        asset_finder = entry['bundle_data'].asset_finder
+
+        # get a list of all sids
+        lifetimes = asset_finder._compute_asset_lifetimes()
+        entry['sids'] = lifetimes.sid
+
+        # retreive all assets in the bundle
+        entry['assets'] = asset_finder.retrieve_all(entry['sids'])
+    return entry
+
+
+def get_tickers_from_bundle(bundle_name):
+    """Gets a list of tickers from a given bundle"""
+    all_assets = _get_cached_assets(bundle_name)['assets']
 
     # return only tickers
     return map(lambda x: (x.symbol, x.sid), all_assets)
@@ -21,22 +68,16 @@ def get_tickers_from_bundle(bundle_name):
 
 def get_all_assets_for_bundle(bundle_name):
     """For a given bundle get a list of all assets"""
-    bundle_data = load(bundle_name, os.environ, None)
-
-    # get a list of all sids
-    lifetimes = bundle_data.asset_finder._compute_asset_lifetimes()
-    all_sids = lifetimes.sid
+    entry = _get_cached_assets(bundle_name)
 
-    print('all_sids: ', all_sids)
+    print('all_sids: ', entry['sids'])
 
-    # retreive all assets in the bundle
-    return bundle_data.asset_finder.retrieve_all(sids=all_sids)
+    return list(entry['assets'])
 
 
 def get_ticker_sid_dict_from_bundle(bundle_name):
     """Packs the (ticker,sid) tuples into a dict."""
-    all_equities = get_tickers_from_bundle(bundle_name)
-    return dict(all_equities)
-
-
-
+    entry = _get_cached_assets(bundle_name)
+    if 'ticker2sid' not in entry:
+        entry['ticker2sid'] = dict(get_tickers_from_bundle(bundle_name))
+    return dict(entry['ticker2sid'])
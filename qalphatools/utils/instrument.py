@@ -0,0 +1,203 @@
+from contextlib import contextmanager
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import psutil
+except ImportError:  # the RSS is read from /proc, or from getrusage
+    psutil = None
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+
+# records of the run are appended to this file, one json object per line
+METRICS_FILE_ENV = 'QALPHATOOLS_METRICS'
+RSS_INTERVAL = 0.05  # seconds between two reads of the RSS while a stage runs
+
+_lock = threading.Lock()
+_run = {'id': None, 'records': []}
+
+
+def metrics_file():
+    """File the records are appended to, $QALPHATOOLS_METRICS or metrics.jsonl in $QUANDL_BASE. None if neither
+    is set"""
+    if METRICS_FILE_ENV in os.environ:
+        return os.environ[METRICS_FILE_ENV]
+    if 'QUANDL_BASE' in os.environ:
+        return os.environ['QUANDL_BASE'] + 'metrics.jsonl'
+    return None
+
+
+def start_run(run_id=None):
+    """
+    Start a new run. Records are tagged with the id of the current run, and summarize only covers the
+    records of the current run
+    :param run_id: id of the run. If None, the start time and the process id
+    :return: id of the run
+    """
+    with _lock:
+        _run['id'] = run_id or '{}-{}'.format(datetime.datetime.now().strftime('%Y%m%dT%H%M%S'), os.getpid())
+        _run['records'] = []
+    return _run['id']
+
+
+def rss_mb(children=False):
+    """
+    Resident memory in MB of this process, with psutil if installed, else from /proc on Linux. Without either,
+    the peak resident memory since the process started, from getrusage. None if unknown, e.g. on Windows
+    without psutil
+    :param children: add the memory of the child processes, e.g. worker processes. From getrusage, the peak
+    of the largest child that already exited
+    """
+    if psutil is not None:
+        process = psutil.Process()
+        rss = process.memory_info().rss
+        if children:
+            for child in process.children(recursive=True):
+                # children exit while they are read
+                try:
+                    rss += child.memory_info().rss
+                except (psutil.NoSuchProcess, psutil.AccessDenied):
+                    pass
+        return rss / 1024. ** 2
+
+    rss = _proc_rss_kb('self')
+    if rss is not None:
+        if children:
+            rss += sum(_proc_rss_kb(pid) or 0 for pid in _proc_children())
+        return rss / 1024.
+
+    if resource is not None:
+        # ru_maxrss is in bytes on macOS and in KB elsewhere
+        unit = 1024. ** 2 if sys.platform == 'darwin' else 1024.
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if children:
+            rss += resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        return rss / unit
+    return None
+
+
+def _proc_rss_kb(pid):
+    """VmRSS in KB of a process from /proc/<pid>/status, None if it can not be read"""
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def _proc_children():
+    """Ids of the direct child processes of this process, from /proc/self/task/<tid>/children"""
+    pids = []
+    try:
+        for task in os.listdir('/proc/self/task'):
+            with open('/proc/self/task/{}/children'.format(task)) as f:
+                pids.extend(f.read().split())
+    except (IOError, OSError):
+        pass
+    return pids
+
+
+def _sample_rss(samples, done, children, interval=RSS_INTERVAL):
+    """Append the RSS to samples every interval seconds until done is set"""
+    while not done.wait(interval):
+        samples.append(rss_mb(children))
+
+
+def emit(record):
+    """Tag a record with the current run, keep it for the summary and append it to the metrics file"""
+    if _run['id'] is None:
+        start_run()
+    record = dict(record, run=_run['id'])
+    path = metrics_file()
+    with _lock:
+        _run['records'].append(record)
+        if path is not None:
+            # metrics never stop a loader
+            try:
+                with open(path, 'a') as f:
+                    f.write(json.dumps(record, default=str) + '\n')
+            except (IOError, OSError) as e:
+                print("could not write metrics to {}: {}".format(path, e))
+    return record
+
+
+@contextmanager
+def measure(stage, children=False, **attrs):
+    """
+    Measure a stage of the loaders. Rows are set on the yielded record:
+
+    with measure('sf1.read') as m:
+        data = read_table(...)
+        m['rows_out'] = data.shape[0]
+
+    The record holds the wall time, the RSS of the process when the stage started and the peak RSS while it
+    ran, rows_in and rows_out if set, and the throughput in rows per second of rows_in, or rows_out if rows_in
+    is not set. The peak is sampled every RSS_INTERVAL seconds by a background thread. RSS is the memory of
+    the whole process, so stages that run at the same time see each other's memory. Both are None if the RSS
+    can not be read, see rss_mb
+
+    :param stage: name of the stage
+    :param children: include the memory of the child processes, for stages that start worker processes
+    :param attrs: extra json serializable items saved in the record
+    """
+    record = {'stage': stage, 'rows_in': None, 'rows_out': None}
+    record.update(attrs)
+    rss_start = rss_mb(children)
+    samples, done = [rss_start], threading.Event()
+    sampler = None
+    if rss_start is not None:
+        sampler = threading.Thread(target=_sample_rss, args=(samples, done, children), name='rss.' + stage)
+        sampler.daemon = True
+        sampler.start()
+    start = time.time()
+    status = 'failed'
+    try:
+        yield record
+        status = 'ok'
+    finally:
+        wall = time.time() - start
+        if sampler is not None:
+            done.set()
+            sampler.join()
+            samples.append(rss_mb(children))
+        samples = [r for r in samples if r is not None]
+        rows = record['rows_out'] if record['rows_in'] is None else record['rows_in']
+        record.update({'status': status,
+                       'start': datetime.datetime.fromtimestamp(start).isoformat(),
+                       'wall_s': round(wall, 3),
+                       'rss_start_mb': round(rss_start, 1) if rss_start is not None else None,
+                       'peak_rss_mb': round(max(samples), 1) if samples else None,
+                       'rows_per_s': round(rows / wall, 1) if rows is not None and wall > 0 else None})
+        emit(record)
+
+
+def summarize(records=None):
+    """
+    Print a table with the records of the current run
+    :param records: List of records. If None, the records of the current run
+    :return: the printed table
+    """
+    records = _run['records'] if records is None else records
+
+    def fmt(value, spec):
+        return format(value, spec) if value is not None else '-'
+
+    lines = ['{:<24} {:>6} {:>10} {:>12} {:>12} {:>12} {:>10} {:>10}'.format(
+        'stage', 'status', 'wall_s', 'rows_in', 'rows_out', 'rows_per_s', 'rss_start', 'rss_peak')]
+    for r in records:
+        lines.append('{:<24} {:>6} {:>10} {:>12} {:>12} {:>12} {:>10} {:>10}'.format(
+            r['stage'], r['status'], fmt(r['wall_s'], '.1f'), fmt(r['rows_in'], 'd'), fmt(r['rows_out'], 'd'),
+            fmt(r['rows_per_s'], '.0f'), fmt(r.get('rss_start_mb'), '.0f'), fmt(r['peak_rss_mb'], '.0f')))
+    table = '\n'.join(lines)
+    print(table)
+    return table
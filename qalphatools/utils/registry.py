@@ -0,0 +1,159 @@
+from qalphatools.utils.bundle import get_ticker_sid_dict_from_bundle
+
+import numpy as np
+import os
+
+from zipline.data.bundles.core import bundles, register
+from zipline.utils.paths import zipline_root
+
+
+REGISTRY_VERSION = 1
+
+
+def registry_path(bundle_name='sep'):
+    """Path of the ticker/sid registry of a bundle, stored in the zipline data dir"""
+    return zipline_root() + '/data/' + '{}_sids.npz'.format(bundle_name.upper())
+
+
+class SidRegistry(object):
+    """
+    Persisted ticker <-> sid index. Sids are assigned once and never reused, so they are stable across
+    re-ingests. A sid keeps its history of tickers: when a company changes ticker (same permaticker in the
+    Sharadar TICKERS table) the new ticker gets the sid of the old one. Delisted tickers keep their sid.
+
+    Stored as a versioned .npz file of plain arrays, one row per (ticker, sid) pair
+    """
+    def __init__(self, tickers=(), sids=(), permatickers=(), current=(), revision=0):
+        self.tickers = list(tickers)
+        self.sids = list(sids)
+        self.permatickers = list(permatickers)
+        self.current = list(current)  # True if the row holds the latest ticker of its sid
+        self.revision = revision
+
+    @classmethod
+    def load(cls, path=None):
+        """
+        Load a registry from disk
+        :param path: Registry file. If None, use the registry of the sep bundle
+        :return: SidRegistry, empty if the file does not exist
+        """
+        path = registry_path() if path is None else path
+        if not os.path.exists(path):
+            return cls()
+
+        with np.load(path, allow_pickle=False) as f:
+            version = int(f['version'])
+            if version != REGISTRY_VERSION:
+                raise ValueError('Unsupported sid registry version {} in {}'.format(version, path))
+            return cls(tickers=f['tickers'].tolist(),
+                       sids=f['sids'].tolist(),
+                       permatickers=f['permatickers'].tolist(),
+                       current=f['current'].tolist(),
+                       revision=int(f['revision']))
+
+    def save(self, path=None):
+        """
+        Save the registry to disk, bumping its revision
+        :param path: Registry file. If None, use the registry of the sep bundle
+        """
+        path = registry_path() if path is None else path
+        self.revision += 1
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f,
+                     version=np.int64(REGISTRY_VERSION),
+                     revision=np.int64(self.revision),
+                     tickers=np.array(self.tickers, dtype=np.str_),
+                     sids=np.array(self.sids, dtype=np.int64),
+                     permatickers=np.array(self.permatickers, dtype=np.int64),
+                     current=np.array(self.current, dtype=np.bool_))
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+
+    @property
+    def num_sids(self):
+        """max(sid) + 1, the size of arrays indexed by sid"""
+        return max(self.sids) + 1 if self.sids else 0
+
+    def ticker2sid(self, include_former=False):
+        """
+        :param include_former: If True, also include former tickers of each sid
+        :return: Dictionary with tickers as keys and sids as values
+        """
+        return {t: s for t, s, c in zip(self.tickers, self.sids, self.current) if c or include_former}
+
+    def sid2ticker(self):
+        """:return: Dictionary with sids as keys and their latest ticker as values"""
+        return {s: t for t, s, c in zip(self.tickers, self.sids, self.current) if c}
+
+    def assign(self, tickers, permatickers=None):
+        """
+        Get sids for tickers, registering the ones that are not known yet. Tickers are matched by permaticker
+        first, when available, and then by ticker. New companies get new sids in sorted ticker order
+
+        :param tickers: Iterable of tickers
+        :param permatickers: Dictionary with tickers as keys and Sharadar permatickers as values. Optional
+        :return: Dictionary with tickers as keys and sids as values
+        """
+        permatickers = {} if permatickers is None else permatickers
+        by_ticker = {t: i for i, (t, c) in enumerate(zip(self.tickers, self.current)) if c}
+        by_perma = {p: i for i, (p, c) in enumerate(zip(self.permatickers, self.current)) if c and p >= 0}
+        next_sid = self.num_sids
+
+        result = {}
+        for ticker in sorted(set(tickers)):
+            perma = permatickers.get(ticker, -1)
+            perma = -1 if perma != perma else int(perma)  # missing permatickers are NaN
+            row = by_perma.get(perma) if perma >= 0 else None
+
+            if row is None:
+                row = by_ticker.get(ticker)
+                if row is not None and perma >= 0 and self.permatickers[row] >= 0 \
+                        and self.permatickers[row] != perma:
+                    # the ticker now belongs to another company, the old one keeps its sid
+                    self.current[row] = False
+                    row = None
+                elif row is not None and perma >= 0:
+                    self.permatickers[row] = perma
+
+            if row is not None and self.tickers[row] == ticker:
+                result[ticker] = self.sids[row]
+                continue
+
+            if row is not None:
+                # ticker change, keep the sid and record the new ticker
+                sid = self.sids[row]
+                self.current[row] = False
+            else:
+                sid = next_sid
+                next_sid += 1
+
+            if ticker in by_ticker and self.current[by_ticker[ticker]]:
+                self.current[by_ticker[ticker]] = False
+
+            self.tickers.append(ticker)
+            self.sids.append(sid)
+            self.permatickers.append(perma)
+            self.current.append(True)
+            by_ticker[ticker] = len(self.tickers) - 1
+            if perma >= 0:
+                by_perma[perma] = len(self.tickers) - 1
+            result[ticker] = sid
+
+        return result
+
+
+def get_ticker_sid_dict(bundle_name='sep'):
+    """
+    Ticker to sid dictionary of a bundle, read from its registry. Bundles ingested before the
+    registry existed fall back to loading the bundle
+    """
+    path = registry_path(bundle_name)
+    if not os.path.exists(path):
+        # loading needs the bundle registered, but never calls its ingest function
+        if bundle_name not in bundles:
+            register(bundle_name, int)
+        return get_ticker_sid_dict_from_bundle(bundle_name)
+    return SidRegistry.load(path).ticker2sid()
@@ -0,0 +1,398 @@
+import numpy as np
+import json
+import os
+import shutil
+import time
+
+
+STORE_FORMAT = 'qalphatools.sparse'
+STORE_VERSION = 1
+DENSE_FORMAT = 'qalphatools.dense'
+DENSE_VERSION = 1
+COLUMNS_FORMAT = 'qalphatools.columns'
+COLUMNS_VERSION = 1
+# ratchet steps tried by StoreCursor.advance before searching the sids that keep moving
+MAX_RATCHET_STEPS = 4
+# readers opening a directory that is being replaced wait REPLACE_WAIT seconds up to REPLACE_RETRIES times
+REPLACE_RETRIES = 50
+REPLACE_WAIT = 0.01
+
+
+def _replace_dir(tmp_path, path):
+    """
+    Move the fully written directory tmp_path to path. A directory already at path is renamed aside first and
+    deleted once the new one is in place, so path is only missing between two renames, and never partially
+    written. Readers that find it missing while the old directory is aside retry, see _cached
+    """
+    old_path = path.rstrip('/') + '.old'
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+    if os.path.exists(path):
+        os.rename(path, old_path)
+    os.rename(tmp_path, path)
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+
+
+def _write_dir(path, write):
+    """
+    Write a directory next to path and then move it in place with _replace_dir, so readers never see a partially
+    written directory
+
+    :param path: directory
+    :param write: function called with the temporary directory that writes the data files and returns the
+    header, a json serializable Dictionary, saved last as header.json
+    """
+    tmp_path = path.rstrip('/') + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    header = write(tmp_path)
+    with open(os.path.join(tmp_path, 'header.json'), 'w') as f:
+        json.dump(header, f)
+
+    _replace_dir(tmp_path, path)
+
+
+def _read_header(path, fmt, version, kind):
+    """Header of a directory written by _write_dir, checked against the format and version expected by kind"""
+    with open(os.path.join(path, 'header.json')) as f:
+        header = json.load(f)
+    if header.get('format') != fmt or header.get('version') != version:
+        raise ValueError('Unsupported {} format {} version {} in {}'.format(
+            kind, header.get('format'), header.get('version'), path))
+    return header
+
+
+class _MappedColumns(object):
+    """
+    Read-only view of a directory with a header and one .npy file per column, memory-mapped on first use, so
+    processes on the same host reading the same directory share its pages through the page cache
+    """
+    format, version, kind = None, None, None
+
+    def __init__(self, path):
+        self.path = path
+        self.header = _read_header(path, self.format, self.version, self.kind)
+        self.columns = {}
+
+    def _load(self, name):
+        return np.load(os.path.join(self.path, name), mmap_mode='r', allow_pickle=False)
+
+    @property
+    def num_sids(self):
+        return self.header['num_sids']
+
+    def has_column(self, name):
+        return name in self.header['columns']
+
+    def column(self, name):
+        """Memory-mapped values of a column, mapped on first use"""
+        if name not in self.columns:
+            if name not in self.header['columns']:
+                raise KeyError('Column {} not in {} {}'.format(name, self.kind, self.path))
+            self.columns[name] = self._load('values_{}.npy'.format(name))
+        return self.columns[name]
+
+
+# one view per kind and directory, shared by all factors of the process
+_views = {}
+
+
+def _cached(kind, path, opener):
+    """
+    Get the shared view of a directory, opened with opener on first use and again when a new directory was
+    written to the same path. Raises IOError if nothing was ever written to path
+    """
+    header_file = os.path.join(path, 'header.json')
+    for _ in range(REPLACE_RETRIES):
+        # a new directory is being moved in place, the old one was renamed aside
+        if os.path.exists(header_file) or not os.path.exists(path.rstrip('/') + '.old'):
+            break
+        time.sleep(REPLACE_WAIT)
+    if not os.path.exists(header_file):
+        raise IOError('No {} in {}, it was never packed'.format(kind, path))
+    version = os.stat(header_file).st_mtime
+    view = _views.get((kind, path))
+    if view is None or view.version != version:
+        view = _views[(kind, path)] = opener(path)
+        view.version = version
+    return view
+
+
+def write_sparse_store(path, dates, offsets, columns, **attrs):
+    """
+    Persist ragged per-sid data as a directory of plain .npy files and a json header. The rows of all sids are
+    concatenated, sid s owns rows offsets[s]:offsets[s + 1] of dates and of each column. The store is written
+    next to path and then moved in place, so readers never see a partially written store
+
+    :param path: store directory
+    :param dates: int64 array with the date of each row, in ns, sorted within each sid
+    :param offsets: int64 array of length N + 1 with the first row of each sid
+    :param columns: Dictionary with column names as keys and arrays aligned with dates as values
+    :param attrs: extra json serializable items saved in the header
+    """
+    def write(tmp_path):
+        np.save(os.path.join(tmp_path, 'dates.npy'), np.asarray(dates, dtype=np.int64))
+        np.save(os.path.join(tmp_path, 'offsets.npy'), np.asarray(offsets, dtype=np.int64))
+        for name, values in columns.items():
+            np.save(os.path.join(tmp_path, 'values_{}.npy'.format(name)), np.asarray(values))
+
+        header = {'format': STORE_FORMAT,
+                  'version': STORE_VERSION,
+                  'num_sids': len(offsets) - 1,
+                  'num_rows': len(dates),
+                  'columns': list(columns)}
+        header.update(attrs)
+        return header
+
+    _write_dir(path, write)
+
+
+class SparseStore(_MappedColumns):
+    """
+    Read-only view of a store written by write_sparse_store. Arrays are memory-mapped
+    """
+    format, version, kind = STORE_FORMAT, STORE_VERSION, 'store'
+
+    def __init__(self, path):
+        super(SparseStore, self).__init__(path)
+        self.dates = self._load('dates.npy')
+        self.offsets = self._load('offsets.npy')
+
+        # sorted (sid, date rank) keys of all rows, built on the first search
+        self._keys = None
+        self._unique_dates = None
+        self._key_base = None
+
+    def _search_keys(self):
+        if self._keys is None:
+            # rows are sorted by sid and then date, so sid * key_base + rank of the date is sorted
+            self._unique_dates, ranks = np.unique(self.dates, return_inverse=True)
+            self._key_base = self._unique_dates.shape[0] + 1
+            sid_of_row = np.repeat(np.arange(self.num_sids, dtype=np.int64), np.diff(self.offsets))
+            self._keys = sid_of_row * self._key_base + ranks.ravel()
+        return self._keys
+
+    def search(self, date, sids=None):
+        """
+        Batched binary search of all sids at once
+        :param date: date in ns
+        :param sids: int array of sids. If None, search all sids
+        :return: int64 array with the position of the latest row on or before date within the
+        rows of each sid, -1 if there is none
+        """
+        keys = self._search_keys()
+        sids = np.arange(self.num_sids, dtype=np.int64) if sids is None else np.asarray(sids, dtype=np.int64)
+
+        # rows of sid s on or before date have keys below s * key_base + rank
+        rank = np.searchsorted(self._unique_dates, date, side='right')
+        counts = np.searchsorted(keys, sids * self._key_base + rank, side='left') - np.asarray(self.offsets)[sids]
+        return counts - 1
+
+
+class StoreCursor(object):
+    """
+    Time index over a SparseStore. time_index holds, for each sid, the position of the latest row on or
+    before curr_date within the rows of that sid, -1 if there is none
+    """
+    def __init__(self, store):
+        self.store = store
+        self.offsets = np.asarray(store.offsets)
+        self.lengths = np.diff(self.offsets)
+        self.time_index = None
+        self.curr_date = None  # date for which time_index is accurate
+        self._located = None  # (date, assets, has_data, positions) of the last call to positions
+
+    def seek(self, date):
+        """Set the time index of every sid with a batched binary search"""
+        self.time_index = self.store.search(date)
+        self.curr_date = date
+
+    def advance(self, date):
+        """Ratchet update.
+
+        for each sid check if date >= dates[self.time_index + 1]
+        if so then increment self.time_index[sid] += 1, and repeat for the sids that moved.
+        Sids still moving after MAX_RATCHET_STEPS, after a jump of several filings, are
+        searched directly. Dates before curr_date are searched from scratch"""
+        if date < self.curr_date:
+            self.seek(date)
+            return
+
+        sids = np.flatnonzero(self.time_index + 1 < self.lengths)  # sids with a next row
+        for _ in range(MAX_RATCHET_STEPS):
+            next_dates = self.store.dates[self.offsets[sids] + self.time_index[sids] + 1]
+            sids = sids[date >= next_dates]
+            if sids.shape[0] == 0:
+                break
+            self.time_index[sids] += 1
+            sids = sids[self.time_index[sids] + 1 < self.lengths[sids]]
+        else:
+            if sids.shape[0]:
+                self.time_index[sids] = self.store.search(date, sids)
+
+        self.curr_date = date
+
+    def move_to(self, date):
+        """Move the time index to date, once per date no matter how many factors ask for it"""
+        if self.time_index is None:
+            self.seek(date)
+        elif date != self.curr_date:
+            self.advance(date)
+
+    def positions(self, assets):
+        """
+        :param assets: int array of sids
+        :return: Tuple (has_data, positions). has_data is a boolean mask of the assets with a row on or before
+        curr_date, and positions are the rows of those assets in the store columns
+        """
+        # factors reading different fields of the store on the same session ask for the same assets
+        if self._located is not None and self._located[0] == self.curr_date \
+                and np.array_equal(self._located[1], assets):
+            return self._located[2:]
+
+        # sids added after the store was written have no rows
+        known = assets < self.lengths.shape[0]
+        time_index = np.full(assets.shape[0], -1, np.dtype('int64'))
+        time_index[known] = self.time_index[assets[known]]
+        has_data = time_index >= 0
+        positions = self.offsets[assets[has_data]] + time_index[has_data]
+
+        self._located = (self.curr_date, np.array(assets), has_data, positions)
+        return has_data, positions
+
+
+def get_cursor(path):
+    """
+    Get the shared cursor of a store, opening the store on first use and again
+    when a new store was written to the same path
+    """
+    return _cached('store', path, lambda p: StoreCursor(SparseStore(p)))
+
+
+def write_dense_panel(store_path, path, sessions, columns=None):
+    """
+    Materialize a store as a dense panel with the latest value of every sid on or before each session, i.e.
+    forward filled, one (sessions x sids) float32 array per column. Built by walking a cursor over the
+    sessions once, so each session costs a row copy when read back. float32 keeps about 7 significant
+    digits, enough for ratios and for amounts in the units used by SF1. The header records the mtime and
+    row count of the store, so get_panel can tell when the store was written again
+
+    :param store_path: store directory, as written by write_sparse_store
+    :param path: panel directory
+    :param sessions: sorted int64 array with the sessions in ns
+    :param columns: columns to materialize. If None, all the columns of the store
+    """
+    # taken before reading the store, a store written meanwhile makes the panel look out of date
+    source_mtime = os.stat(os.path.join(store_path, 'header.json')).st_mtime
+    store = SparseStore(store_path)
+    columns = store.header['columns'] if columns is None else list(columns)
+    sessions = np.asarray(sessions, dtype=np.int64)
+    assets = np.arange(store.num_sids, dtype=np.int64)
+
+    def write(tmp_path):
+        np.save(os.path.join(tmp_path, 'sessions.npy'), sessions)
+        panels = {name: np.lib.format.open_memmap(os.path.join(tmp_path, 'values_{}.npy'.format(name)),
+                                                  mode='w+', dtype=np.float32,
+                                                  shape=(sessions.shape[0], store.num_sids))
+                  for name in columns}
+
+        cursor = StoreCursor(store)
+        for i, session in enumerate(sessions):
+            cursor.move_to(session)
+            has_data, positions = cursor.positions(assets)
+            for name, panel in panels.items():
+                row = np.full(store.num_sids, np.nan, np.float32)
+                row[has_data] = store.column(name)[positions]
+                panel[i] = row
+        for panel in panels.values():
+            panel.flush()
+
+        return {'format': DENSE_FORMAT,
+                'version': DENSE_VERSION,
+                'num_sids': store.num_sids,
+                'num_sessions': sessions.shape[0],
+                'columns': columns,
+                'source': store_path,
+                'source_mtime': source_mtime,
+                'source_rows': store.header['num_rows']}
+
+    _write_dir(path, write)
+
+
+class DensePanel(_MappedColumns):
+    """
+    Read-only view of a panel written by write_dense_panel. Arrays are memory-mapped, so reading a session
+    only touches the pages of its rows
+    """
+    format, version, kind = DENSE_FORMAT, DENSE_VERSION, 'panel'
+
+    def __init__(self, path):
+        super(DensePanel, self).__init__(path)
+        self.sessions = self._load('sessions.npy')
+
+    def row(self, date):
+        """:return: row of session date, -1 if date is not a session of the panel"""
+        i = np.searchsorted(self.sessions, date)
+        if i < self.sessions.shape[0] and self.sessions[i] == date:
+            return i
+        return -1
+
+
+def get_panel(path, source=None):
+    """
+    Get the shared panel in a directory, opening it on first use and again when a new panel was written
+    to the same path. None if there is no panel
+
+    :param path: panel directory
+    :param source: store directory the panel was built from. If given, None when the store was written
+    again after the panel was built, so its values may be out of date
+    """
+    if not os.path.exists(os.path.join(path, 'header.json')):
+        return None
+    panel = _cached('panel', path, DensePanel)
+    if source is not None:
+        store = get_cursor(source).store
+        mtime = os.stat(os.path.join(source, 'header.json')).st_mtime
+        if (panel.header.get('source_mtime'), panel.header.get('source_rows')) != (mtime, store.header['num_rows']):
+            return None
+    return panel
+
+
+def write_columns(path, columns, **attrs):
+    """
+    Persist per-sid columns, where row s holds the value of sid s, as a directory of plain .npy files and
+    a json header. Columns keep their dtype
+
+    :param path: directory
+    :param columns: Dictionary with column names as keys and arrays of the same length as values
+    :param attrs: extra json serializable items saved in the header
+    """
+    def write(tmp_path):
+        for name, values in columns.items():
+            np.save(os.path.join(tmp_path, 'values_{}.npy'.format(name)), np.asarray(values))
+
+        lengths = set(len(values) for values in columns.values())
+        header = {'format': COLUMNS_FORMAT,
+                  'version': COLUMNS_VERSION,
+                  'num_sids': lengths.pop() if lengths else 0,
+                  'columns': list(columns)}
+        header.update(attrs)
+        return header
+
+    _write_dir(path, write)
+
+
+class Columns(_MappedColumns):
+    """Read-only view of columns written by write_columns, memory-mapped on first use"""
+    format, version, kind = COLUMNS_FORMAT, COLUMNS_VERSION, 'columns'
+
+
+def get_columns(path):
+    """
+    Get the shared view of the columns in a directory, opening it on first use and again when new
+    columns were written to the same path
+    """
+    return _cached('columns', path, Columns)
@@ -0,0 +1,174 @@
+import numpy as np
+import pandas as pd
+import os
+
+from qalphatools.utils.store import _write_dir, _read_header
+
+
+TABLE_FORMAT = 'qalphatools.table'
+TABLE_VERSION = 1
+# Sharadar columns stored as datetime64, all other columns are stored as float64 or as strings
+DATE_COLUMNS = ['date', 'datekey', 'calendardate', 'reportperiod', 'lastupdated', 'firstadded',
+                'firstpricedate', 'lastpricedate', 'firstquarter', 'lastquarter']
+CHUNK_ROWS = 1000000  # csv rows parsed at a time while converting
+
+
+def _typed(values, name):
+    """Convert a column of a parsed csv chunk to the array stored for it"""
+    if name in DATE_COLUMNS:
+        return pd.to_datetime(values).values.astype('datetime64[ns]')
+    if values.dtype.kind == 'O':
+        # missing strings are stored as empty strings
+        return np.asarray(values.fillna('').astype(str).values, dtype=np.str_)
+    return values.values.astype(np.float64)
+
+
+def _as_strings(values):
+    if values.dtype.kind == 'U':
+        return values
+    return np.array(['' if v != v else str(v) for v in values.tolist()], dtype=np.str_)
+
+
+def convert_csv(file_ref, path, chunk_rows=CHUNK_ROWS):
+    """
+    Convert a csv table, e.g. a member of a Sharadar bulk zip file, into a directory of typed columns,
+    one .npy file per column, with the rows partitioned by ticker. The csv is parsed once, in chunks, and
+    can be streamed from an open file
+
+    :param file_ref: csv file name or open file object
+    :param path: table directory
+    :param chunk_rows: csv rows parsed at a time
+    """
+    def write(tmp_path):
+        # every chunk is saved as it is parsed, and the chunks of each column joined at the end
+        columns, num_chunks, num_rows = None, 0, 0
+        for chunk in pd.read_csv(file_ref, chunksize=chunk_rows, low_memory=False):
+            columns = list(chunk.columns) if columns is None else columns
+            for name in columns:
+                np.save(os.path.join(tmp_path, 'chunk{}_{}.npy'.format(num_chunks, name)),
+                        _typed(chunk[name], name))
+            num_chunks += 1
+            num_rows += chunk.shape[0]
+        columns = columns or []
+
+        def load_column(name):
+            parts = [np.load(os.path.join(tmp_path, 'chunk{}_{}.npy'.format(i, name)), mmap_mode='r')
+                     for i in range(num_chunks)]
+            if any(p.dtype.kind == 'U' for p in parts):
+                parts = [_as_strings(np.asarray(p)) for p in parts]
+            return np.concatenate(parts) if parts else np.array([], dtype=np.float64)
+
+        # stable sort by ticker, so each ticker is a contiguous range of rows in the original order
+        # a table without tickers is a single partition
+        tickers, offsets = np.array([''], dtype=np.str_), np.array([0, num_rows], dtype=np.int64)
+        order = None
+        if 'ticker' in columns:
+            ticker = load_column('ticker')
+            order = np.argsort(ticker, kind='mergesort')
+            tickers, starts = np.unique(ticker[order], return_index=True)
+            offsets = np.append(starts, num_rows).astype(np.int64)
+            del ticker
+
+        for name in columns:
+            values = load_column(name)
+            np.save(os.path.join(tmp_path, 'values_{}.npy'.format(name)),
+                    values if order is None else values[order])
+            for i in range(num_chunks):
+                os.remove(os.path.join(tmp_path, 'chunk{}_{}.npy'.format(i, name)))
+        np.save(os.path.join(tmp_path, 'tickers.npy'), tickers)
+        np.save(os.path.join(tmp_path, 'offsets.npy'), offsets)
+
+        return {'format': TABLE_FORMAT,
+                'version': TABLE_VERSION,
+                'num_rows': num_rows,
+                'columns': columns}
+
+    _write_dir(path, write)
+
+
+def is_table(path):
+    """True if path is a table directory written by convert_csv"""
+    return os.path.isfile(os.path.join(path, 'header.json'))
+
+
+def read_header(path):
+    """Header of a table directory, with its number of rows and columns"""
+    return _read_header(path, TABLE_FORMAT, TABLE_VERSION, 'table')
+
+
+def table_columns(path):
+    """Columns of a table directory, or of a csv bulk file"""
+    if is_table(path):
+        return read_header(path)['columns']
+    return list(pd.read_csv(path, nrows=0).columns)
+
+
+def table_tickers(path):
+    """
+    Tickers of a table directory and their number of rows, without reading the rows
+    :return: Tuple of arrays (tickers, rows), sorted by ticker
+    """
+    offsets = np.load(os.path.join(path, 'offsets.npy'), allow_pickle=False)
+    tickers = np.load(os.path.join(path, 'tickers.npy'), allow_pickle=False)
+    return tickers, np.diff(offsets)
+
+
+def _ticker_ranges(path, tickers):
+    """Start and end rows of each ticker of the table in tickers, all rows if tickers is None"""
+    offsets = np.load(os.path.join(path, 'offsets.npy'), allow_pickle=False)
+    if tickers is None:
+        return offsets[:-1], offsets[1:]
+    stored = np.load(os.path.join(path, 'tickers.npy'), allow_pickle=False)
+    keep = np.flatnonzero(np.isin(stored, np.asarray(list(tickers), dtype=np.str_)))
+    return offsets[keep], offsets[keep + 1]
+
+
+def _frame(path, columns, rows):
+    data = {}
+    for name in columns:
+        values = np.load(os.path.join(path, 'values_{}.npy'.format(name)), mmap_mode='r', allow_pickle=False)
+        values = np.asarray(values[rows])
+        if values.dtype.kind == 'U':
+            # back to the object strings and missing values of read_csv
+            values = pd.Series(values, dtype=object).replace('', np.nan).values
+        data[name] = values
+    return pd.DataFrame(data, columns=columns)
+
+
+def iter_table(path, columns=None, tickers=None, chunk_rows=CHUNK_ROWS):
+    """
+    Read a table in chunks of whole tickers
+    :param path: table directory written by convert_csv
+    :param columns: columns to read. If None, all columns
+    :param tickers: Iterable of tickers to read. If None, all tickers
+    :param chunk_rows: rows per chunk, a chunk holds more rows if a single ticker does
+    :return: generator of DataFrames
+    """
+    columns = read_header(path)['columns'] if columns is None else list(columns)
+    starts, ends = _ticker_ranges(path, tickers)
+
+    i = 0
+    while i < starts.shape[0]:
+        # the tickers that fit in chunk_rows, at least one
+        j = max(i + 1, np.searchsorted(np.cumsum(ends[i:] - starts[i:]), chunk_rows, side='right') + i)
+        lengths = ends[i:j] - starts[i:j]
+        rows = np.repeat(starts[i:j] - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        yield _frame(path, columns, rows)
+        i = j
+
+
+def read_table(path, columns=None, tickers=None):
+    """
+    Read a Sharadar table converted by convert_csv, or a csv bulk file
+    :param path: table directory or csv file
+    :param columns: columns to read. If None, all columns
+    :param tickers: Iterable of tickers to read. If None, all tickers
+    :return: DataFrame
+    """
+    if not is_table(path):
+        df = pd.read_csv(path, usecols=columns)
+        return df if tickers is None else df[df.ticker.isin(tickers)].reset_index(drop=True)
+
+    columns = read_header(path)['columns'] if columns is None else list(columns)
+    frames = list(iter_table(path, columns, tickers, chunk_rows=np.iinfo(np.int64).max))
+    return frames[0] if frames else _frame(path, columns, np.array([], dtype=np.int64))
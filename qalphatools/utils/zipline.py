@@ -1,7 +1,6 @@
 import pandas as pd
 
 from zipline.data.data_portal import DataPortal
-from zipline.data import bundles
 from zipline.data.bundles import register
 from zipline.data.bundles.csvdir import csvdir_equities
 from zipline.utils.calendars import get_calendar
@@ -12,6 +11,7 @@ from zipline.pipeline.engine import SimplePipelineEngine
 from zipline.pipeline.factors import AverageDollarVolume
 
 from qalphatools.factors.fundamentals import Fundamentals
+from qalphatools.utils.bundle import load_bundle
 
 
 class SEP:
@@ -20,7 +20,7 @@ class SEP:
     """
     def __init__(self):
         register_data(None, None, 'sep', 'daily')
-        self.bundle_data = bundles.load('sep')
+        self.bundle_data = load_bundle('sep')
         self.trading_calendar = get_calendar('NYSE')
         self.engine = build_pipeline_engine(self.bundle_data, self.trading_calendar)
 
@@ -0,0 +1,130 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:  # python 2
+    import mock
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from qalphatools.loaders import bulk_quandl
+
+
+PAYLOAD = os.urandom(300000)
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """Serves PAYLOAD with range support, and 416 for ranges past its end. The first drops connections are
+    cut after a third of the bytes, and every request gets status instead if it is set"""
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.drops = 0
+        self.status = None
+        self.requests = []
+
+    @property
+    def link(self):
+        return 'http://127.0.0.1:%d/file.zip' % self.server_address[1]
+
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        rng = self.headers.get('Range')
+        server.requests.append(rng)
+        if server.status is not None:
+            self.send_error(server.status)
+            return
+
+        start = int(rng.split('=')[1].rstrip('-')) if rng else 0
+        if start >= len(PAYLOAD):
+            self.send_error(416)
+            return
+        self.send_response(206 if rng else 200)
+        self.send_header('Content-Length', str(len(PAYLOAD) - start))
+        self.end_headers()
+        if server.drops:
+            server.drops -= 1
+            self.wfile.write(PAYLOAD[start:start + len(PAYLOAD) // 3])
+            self.wfile.flush()
+            self.connection.shutdown(2)
+            return
+        self.wfile.write(PAYLOAD[start:])
+
+
+class DownloadFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.dest = os.path.join(self.folder, 'SEP_download.csv.zip')
+        self.server = StandInServer()
+        threading.Thread(target=self.server.serve_forever).start()
+        self.sleep = mock.patch.object(bulk_quandl.time, 'sleep')
+        self.sleep.start()
+
+    def tearDown(self):
+        self.sleep.stop()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.folder)
+
+    def read_dest(self):
+        with open(self.dest, 'rb') as f:
+            return f.read()
+
+    def test_resumes_dropped_connection(self):
+        self.server.drops = 1
+        bulk_quandl.download_file(self.server.link, self.dest, chunk_size=4096, version='2020-01-02 10:00:00')
+
+        self.assertEqual(self.read_dest(), PAYLOAD)
+        self.assertEqual(self.server.requests, [None, 'bytes=%d-' % (len(PAYLOAD) // 3)])
+        self.assertEqual(os.listdir(self.folder), ['SEP_download.csv.zip'])
+
+    def test_does_not_resume_other_version(self):
+        with open(self.dest + '.2020_01_01_10_00_00.part', 'wb') as f:
+            f.write(b'x' * 1000)
+        bulk_quandl.download_file(self.server.link, self.dest, version='2020-01-02 10:00:00')
+
+        self.assertEqual(self.read_dest(), PAYLOAD)
+        self.assertEqual(self.server.requests, [None])
+        self.assertEqual(os.listdir(self.folder), ['SEP_download.csv.zip'])
+
+    def test_client_errors_are_not_retried(self):
+        self.server.status = 403
+        with self.assertRaises(bulk_quandl.HTTPError):
+            bulk_quandl.download_file(self.server.link, self.dest)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertFalse(os.path.exists(self.dest))
+
+    def test_unsatisfiable_range_starts_over(self):
+        with open(self.dest + '.part', 'wb') as f:
+            f.write(b'x' * (len(PAYLOAD) + 10))
+        bulk_quandl.download_file(self.server.link, self.dest)
+        self.assertEqual(self.server.requests, ['bytes=%d-' % (len(PAYLOAD) + 10), None])
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(f.read(), PAYLOAD)
+        self.assertEqual(os.listdir(self.folder), ['SEP_download.csv.zip'])
+
+    def test_server_errors_are_retried(self):
+        self.server.status = 503
+        with self.assertRaises(bulk_quandl.HTTPError):
+            bulk_quandl.download_file(self.server.link, self.dest, max_retries=3)
+        self.assertEqual(len(self.server.requests), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()